@@ -0,0 +1,42 @@
+'''
+per-tick latency of TCIController.step for many beds on one host
+usage: python benchmarks/bench_controller.py [number of beds] [hours]
+'''
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tivatci
+
+if __name__ == '__main__':
+    nbed = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+    tmax = int(hours * 3600)
+    names = ['schnider', 'eleveld', 'modified marsh', 'minto']
+    rng = np.random.default_rng(0)
+
+    beds = []
+    for i in range(nbed):
+        model = tivatci.Model(names[i % len(names)], rng.integers(20, 80), rng.choice(['M', 'F']), rng.uniform(50, 100), rng.uniform(150, 190))
+        targets = np.full(tmax, np.nan)
+        targets[rng.choice(tmax, 5, replace=False)] = rng.uniform(1, 5, 5)  # a few target changes per case
+        targets[0] = 3
+        beds.append((tivatci.TCIController(model, maxrate=rng.choice([None, 20])), targets))
+
+    for ctl, _ in beds:  # build the cached udf and decay responses
+        ctl.model.udf()
+        ctl.model.decay()
+
+    lat = np.empty((tmax, nbed))
+    for t in range(tmax):
+        for j, (ctl, targets) in enumerate(beds):
+            target = targets[t]
+            start = time.perf_counter()
+            ctl.step(None if np.isnan(target) else target)
+            ctl.record
+            lat[t, j] = time.perf_counter() - start
+    lat *= 1e6
+    print(f'{nbed} beds x {tmax} ticks')
+    print(f'per tick latency (us): median {np.median(lat):.1f}, p99 {np.percentile(lat, 99):.1f}, max {lat.max():.1f}')
+    print(f'all beds per 1 Hz cycle (ms): median {np.median(lat.sum(axis=1)) / 1000:.2f}, max {lat.sum(axis=1).max() / 1000:.2f}')
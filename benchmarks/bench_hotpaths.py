@@ -0,0 +1,165 @@
+'''
+timings of the simulation hot paths with the regression check against the golden outputs
+every benchmark of every registered model is timed and its result is compared with benchmarks/golden.npz,
+so a speed-up can be shown not to change the clinical numbers
+usage: python benchmarks/bench_hotpaths.py [--update] [--models schnider,minto] [--repeat 3] [--skip-cohort]
+    --update: rewrite the golden outputs from the current code (only after a change of the results is intended)
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tivatci
+
+here = os.path.dirname(os.path.abspath(__file__))
+golden_path = os.path.join(here, 'golden.npz')
+rtol = 1e-6  # tolerance of the results to the golden outputs
+atol = 1e-9
+
+# demographics of the benchmarks (the paediatric models need a child)
+adult = (40, 'M', 70, 170)
+child = (8, 'F', 25, 125)
+paediatric = {'paedfusor', 'kataria', 'choi'}
+
+# target profiles
+short = [4] * 200 + [3] * 200 + [5] * 160 + [2] * 200 + [0] * 500  # as sample.py, 21 min
+long_changes = [(0, 3), (1800, 2.5), (7200, 3), (14400, 2), (28800, 2.5), (39600, 0)]  # 12 hours
+long_tmax = 12 * 3600
+maxrate = 10  # per second
+
+
+def timeit(func, repeat):
+    '''
+    returns: (result of the last call, minimum seconds)
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ret = func()
+        best = min(best, time.perf_counter() - start)
+    return ret, best
+
+
+def fresh(name):
+    '''
+    model without the cached udf and decay responses
+    '''
+    demo = child if name in paediatric else adult
+    return tivatci.Model(name, *demo)
+
+
+def model_benchmarks(name):
+    '''
+    returns: list of (benchmark, function that returns the result to check)
+    the long results are subsampled to keep the golden outputs small (a changed rate decision persists in the later rows)
+    '''
+    model = fresh(name)
+    benches = [
+        ('sim', lambda: model.sim(3600, dose=[1] * 10)[::60]),
+        ('udf', lambda: np.concatenate([fresh(name).udf(), fresh(name).udf(plasma=True)])),
+        ('tci', lambda: np.array(fresh(name).tci(3, np.array([1, 2, 3, 0.01]))[:2])),
+        ('tci_warm', lambda: np.array(model.tci(3, np.array([1, 2, 3, 0.01]))[:2])),
+        ('recalc_ke0', lambda: np.array([model.recalc_ke0(t) for t in (60, 90, 120, 240)])),
+    ]
+    for plasma in (False, True):
+        for rate in (None, maxrate):
+            tag = f"{'plasma' if plasma else 'effect'}{'_maxrate' if rate else ''}"
+            benches.append((f'run_short_{tag}', lambda plasma=plasma, rate=rate: model._run(short, rate, plasma)[::20]))
+            benches.append((f'run_12h_{tag}', lambda plasma=plasma, rate=rate: model._run(long_changes, rate, plasma, tmax=long_tmax)[::600]))
+    return benches
+
+
+def cohort_benchmarks():
+    '''
+    returns: list of (benchmark, function that returns the result to check)
+    '''
+    rng = np.random.default_rng(0)
+    n = 500
+    age = rng.uniform(20, 80, n).round()
+    sex = rng.choice(['M', 'F'], n)
+    weight = rng.uniform(50, 100, n).round()
+    height = rng.uniform(150, 190, n).round()
+    cts = np.repeat([3, 2.5, 3.5, 0], 900)  # 1 hour
+    doses = rng.uniform(0, 2, (n, 3600)) * (rng.uniform(size=(n, 3600)) < 0.2)
+    scenarios = [{'name': 'schnider', 'age': age[i], 'sex': sex[i], 'weight': weight[i], 'height': height[i],
+                  'cts': [(0, 3), (900, 2.5), (1800, 3.5), (2700, 0)], 'tmax': 3600} for i in range(50)]
+    return [
+        ('batch_build', lambda: tivatci.ModelBatch('eleveld', age, sex, weight, height).v1),
+        ('batch_run_1h', lambda: tivatci.ModelBatch('schnider', age, sex, weight, height).run(cts, maxrate=maxrate)[:, ::600]),
+        ('run_many_50x1h', lambda: np.stack(tivatci.run_many(scenarios, workers=1))[:, ::600]),
+        ('replay_500x1h', lambda: tivatci.replay(tivatci.Model('schnider', *adult), doses)[:, ::600]),
+    ]
+
+
+def check_result_csv():
+    '''
+    result.csv was written by an older version of the algorithm and matches the current run only until its first re-decision at 107 sec
+    '''
+    path = os.path.join(os.path.dirname(here), 'result.csv')
+    if not os.path.exists(path):
+        return None
+    golden = np.genfromtxt(path, delimiter=',', skip_header=1)[:107]  # index, Cp, Ct, Ce, Rate
+    ret = tivatci.Model('schnider', 80, 'M', 75, 172)._run(short)[:107]  # Ct, Cp, Ce, Rate, Infused
+    return np.allclose(ret[:, [1, 0, 2, 3]], golden[:, 1:], rtol=rtol, atol=atol)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='timings of the simulation hot paths with the regression check')
+    parser.add_argument('--update', action='store_true', help='rewrite the golden outputs')
+    parser.add_argument('--models', help='comma separated names of the models (default: every registered model)')
+    parser.add_argument('--repeat', type=int, default=3, help='repeats of each timing (the minimum is reported)')
+    parser.add_argument('--skip-cohort', action='store_true', help='skip the cohort-scale scenarios')
+    args = parser.parse_args()
+
+    if args.models:
+        names = args.models.split(',')
+    else:  # every registered model without the aliases
+        names = {}
+        for name, func in tivatci.registry.items():
+            names.setdefault(func, name)
+        names = list(names.values())
+    golden = {}
+    if os.path.exists(golden_path) and not args.update:
+        golden = dict(np.load(golden_path))
+
+    benches = [(f'{name}/{bench}', func) for name in names for bench, func in model_benchmarks(name)]
+    if not args.skip_cohort:
+        benches += [(f'cohort/{bench}', func) for bench, func in cohort_benchmarks()]
+
+    results = {}
+    failed = []
+    print(f"{'benchmark':45s} {'ms':>10s}  check")
+    for key, func in benches:
+        ret, sec = timeit(func, args.repeat)
+        ret = np.asarray(ret, dtype=float)
+        results[key] = ret
+        if args.update:
+            status = 'updated'
+        elif key not in golden:
+            status = 'no golden'
+        elif golden[key].shape == ret.shape and np.allclose(ret, golden[key], rtol=rtol, atol=atol, equal_nan=True):
+            status = 'ok'
+        else:
+            status = 'FAILED'
+            failed.append(key)
+        print(f'{key:45s} {sec * 1000:10.2f}  {status}')
+
+    ok = check_result_csv()
+    if ok is not None:
+        print(f"{'result.csv (first 107 sec)':45s} {'':10s}  {'ok' if ok else 'FAILED'}")
+        if not ok:
+            failed.append('result.csv')
+
+    if args.update:
+        if not args.models and not args.skip_cohort:
+            np.savez_compressed(golden_path, **results)
+        else:  # keep the golden outputs of the other benchmarks
+            old = dict(np.load(golden_path)) if os.path.exists(golden_path) else {}
+            old.update(results)
+            np.savez_compressed(golden_path, **old)
+        print(f'golden outputs written to {golden_path}')
+    if failed:
+        print(f'{len(failed)} benchmarks differ from the golden outputs: {", ".join(failed)}')
+        sys.exit(1)
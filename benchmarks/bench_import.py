@@ -0,0 +1,31 @@
+'''
+startup time of `import tivatci`
+pandas, matplotlib and scipy must not be imported until they are used
+usage: python benchmarks/bench_import.py [number of repeats]
+'''
+import os
+import sys
+import time
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+heavy = ('pandas', 'matplotlib', 'scipy')
+
+def run(code):
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True).stdout
+    return time.perf_counter() - start, out
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    _, out = run('import sys, tivatci; print(" ".join(m for m in %r if m in sys.modules))' % (heavy,))
+    assert not out.strip(), f'imported at startup: {out.strip()}'
+
+    for name, code in [('python', 'pass'), ('numpy', 'import numpy'), ('tivatci', 'import tivatci'), ('tivatci + pandas', 'import tivatci, pandas')]:
+        times = sorted(run(code)[0] for _ in range(n))
+        print(f'{name:20s} median {times[n // 2] * 1000:7.1f} ms')
+
+    _, out = run('import tivatci; m = tivatci.Model("schnider"); r = m.run([3] * 600, return_type="numpy"); import sys; print(" ".join(m for m in %r if m in sys.modules))' % (heavy,))
+    assert not out.strip(), f'imported by run(return_type="numpy"): {out.strip()}'
+    print('no pandas/matplotlib/scipy imported by import tivatci and run(return_type="numpy")')
@@ -0,0 +1,38 @@
+'''
+scaling of tivatci.run_many with the number of worker processes
+usage: python benchmarks/bench_run_many.py [number of scenarios]
+'''
+import os
+import sys
+import time
+import itertools
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tivatci
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    names = ['schnider', 'eleveld', 'modified marsh', 'minto']
+    profiles = [
+        [4] * 200 + [3] * 200 + [5] * 160 + [2] * 200 + [0] * 500,
+        [3] * 3600,
+    ]
+    combos = list(itertools.product(names, profiles, [None, 20], [False, True]))
+    scenarios = []
+    for i in range(n):
+        name, cts, maxrate, plasma = combos[i % len(combos)]
+        scenarios.append({'name': name, 'age': 40, 'sex': 'M', 'weight': 75, 'height': 172, 'cts': cts, 'maxrate': maxrate, 'plasma': plasma})
+
+    t = time.perf_counter()
+    serial = [tivatci.Model(s['name'], s['age'], s['sex'], s['weight'], s['height']).run(s['cts'], maxrate=s['maxrate'], plasma=s['plasma']) for s in scenarios]
+    t_serial = time.perf_counter() - t
+    print(f'serial Model.run: {t_serial:.2f} s for {n} scenarios')
+
+    ncpu = os.cpu_count() or 1
+    for workers in sorted({1, 2, 4, 8, 16, ncpu} & set(range(1, ncpu + 1))):
+        t = time.perf_counter()
+        res = tivatci.run_many(scenarios, workers=workers, chunksize=max(1, n // (workers * 4)))
+        elapsed = time.perf_counter() - t
+        for df, arr in zip(serial, res):
+            assert np.array_equal(df[list(tivatci.Model.columns)].to_numpy(), arr)
+        print(f'workers={workers:3d}: {elapsed:.2f} s, speedup {t_serial / elapsed:.1f}x')
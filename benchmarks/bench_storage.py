@@ -0,0 +1,62 @@
+'''
+write throughput of the results: csv of pandas versus the columnar ResultWriter
+usage: python benchmarks/bench_storage.py [number of patients] [hours] [directory]
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tivatci
+
+if __name__ == '__main__':
+    npat = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+    root = sys.argv[3] if len(sys.argv) > 3 else tempfile.mkdtemp()
+    tmax = int(hours * 3600)
+    rng = np.random.default_rng(0)
+    case = rng.uniform(0, 5, (tmax, 5))  # stands for the result of one patient
+
+    def csv(path):
+        import pandas as pd
+        with open(path + '.csv', 'w') as f:
+            for i in range(npat):
+                pd.DataFrame(case, columns=tivatci.Model.columns).assign(Case=i).to_csv(f, index=False, header=i == 0)
+
+    def writer(path, **kwds):
+        with tivatci.ResultWriter(path, index=('Case',), **kwds) as w:
+            for i in range(npat):
+                w.write(case, Case=i)
+
+    def raw(path):  # the same bytes written without any conversion
+        with open(path + '.bin', 'wb') as f:
+            data = case.astype(np.float32).tobytes()
+            for i in range(npat):
+                f.write(data)
+
+    tests = [('raw float32 bytes', raw), ('npy float32', writer), ('npy float64', lambda path: writer(path, dtype=np.float64))]
+    try:
+        import pyarrow
+        tests.append(('parquet float32', lambda path: writer(path, format='parquet')))
+    except ImportError:
+        pass
+    tests.append(('csv (pandas)', csv))
+
+    print(f'{npat} patients x {tmax} sec = {npat * tmax} rows')
+    for name, func in tests:
+        path = os.path.join(root, name.split(' (')[0].replace(' ', '_'))
+        start = time.perf_counter()
+        func(path)
+        sec = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(d, x)) for d, _, xs in os.walk(path) for x in xs) if os.path.isdir(path) else \
+            sum(os.path.getsize(path + ext) for ext in ('.csv', '.bin') if os.path.exists(path + ext))
+        print(f'{name:20s} {sec:8.2f} sec {size / 1e6:9.1f} MB {size / 1e6 / sec:8.1f} MB/s')
+
+    data = tivatci.read_results(os.path.join(root, 'npy_float32'))
+    start = time.perf_counter()
+    data['Ce'][data['Case'] == npat // 2].mean()
+    print(f'memory-mapped read of one patient: {time.perf_counter() - start:.3f} sec')
+    if len(sys.argv) <= 3:
+        shutil.rmtree(root)
@@ -1,14 +1,22 @@
+import time
+import functools
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import scipy.optimize as optimize
+# pandas, matplotlib and scipy are imported where they are used to keep `import tivatci` cheap
 
 class Model:
-    def __init__(self, name=None, age=30, sex='F', weight=60, height=160, v1=None, k10=0, k12=0, k13=0, k21=0, k31=0, v2=0, v3=0, q1=0, q2=0, q3=0, ke0=0):
+    method = 'euler'
+    dt = 1  # time step of the simulation in seconds
+    def __init__(self, name=None, age=30, sex='F', weight=60, height=160, v1=None, k10=0, k12=0, k13=0, k21=0, k31=0, v2=0, v3=0, q1=0, q2=0, q3=0, ke0=0, method='euler', dt=1):
         '''
         set the model parameters based on the name of the model and the patient
         time constants are always in min^-1
+        method: propagation engine of the simulation
+            'euler': forward euler update every step (reproduces the previous results)
+            'exact': closed-form solution of the compartment equations
+        dt: default time step in seconds of sim, cp, ce, udf, decay, tci and run
         '''
+        self.method = method
+        self.dt = dt
         if name is not None:
             name = name.lower()
         # either k or name should be provided
@@ -17,180 +25,8 @@ class Model:
                 self.setk(v1, k10, k12, k13, k21, k31, ke0)
             elif v2 or v3 or q1 or q2 or q3:
                 self.setq(v1, v2, v3, q1, q2, q3, ke0)
-        elif name == 'marsh':  
-            # Marsh et al. Pharmacokinetic model driven infusion of propofol in children. Br J Anaesth 1991;67:41-8
-            self.setk(0.228 * weight, 0.119, 0.114, 0.0419, 0.055, 0.0033, 0.26) # diprifusor
-        elif name == 'modified marsh':
-            self.setk(0.228 * weight, 0.119, 0.114, 0.0419, 0.055, 0.0033, 1.2195)  # stanpump, orchestra
-        elif name == 'schnider':
-            lbm = calc_lbm(sex, weight, height)
-            self.setq(4.27, 18.9 - 0.391 * (age - 53), 238,
-                1.89 + 0.0456 * (weight - 77) - 0.0681 * (lbm - 59) + 0.0264 * (height - 177),
-                1.29 - 0.024 * (age - 53), 0.836, 
-                0.456)
-        elif name == 'paedfusor':
-            if 1 <= age < 13:
-                v1 = 0.4584 * weight
-                k10 = 0.1527 * weight ** -0.3
-            elif age <= 13:
-                v1 = 0.4 * weight
-                k10 = 0.0678
-            elif age <= 14:
-                v1 = 0.342 * weight
-                k10 = 0.0792
-            elif age <= 15:
-                v1 = 0.284 * weight
-                k10 = 0.0954
-            elif age <= 16:
-                v1 = 0.22857 * weight
-                k10 = 0.119
-            else:
-                raise ValueError
-            ke0 = 0.26  # from diprifusor (for adults)
-            ke0 = 0.91  # Munoz et al Anesthesiology 2004:101(6)
-            self.setk(v1, k10, 0.114, 0.0419, 0.055, 0.0033, ke0) 
-        elif name == 'kataria':  
-            # Kataria et al. The pharmacokinetics of propofol in children using three different data analysis approaches. Anesthesiology 1994;80:104
-            self.setq(0.41 * weight, 0.78 * weight + 3.1 * age - 15.5, 6.9 * weight,
-                0.035 * weight, 0.077 * weight, 0.026 * weight,
-                0.41) # Munoz et al Anesthesiology 2004:101(6)
-        elif name == 'choi':  # propofol
-            # Choi et al. Population pharmacokinetic and pharmacodynamic model of propofol externally validated in children. J Pharmacokinet Pharmacodyn. 2015 Apr;42(2):163-77
-            self.setq(1.69, 27.2 + 0.93 * (weight - 25), 0,
-                0.89 * (weight / 23.6) ** 0.97, 1.3, 0, 
-                0.371)
-        elif name == 'eleveld':
-            t1 = 6.28 # v1 ref
-            t2 = 25.5 # v2 ref
-            t3 = 273 # v3 ref
-            t4 = 1.79 # cl ref
-            t5 = 1.75 # q2 ref
-            t6 = 1.11 # q3 ref
-            t8 = 42.3 # cl maturation e50
-            t9 = 9.06 # cl maturation slope
-            t10 = -0.0156 # smaller v2 with age
-            t11 = -0.00286 # lower cl with age
-            t12 = 33.6 # v1 sigmoid e50=33.6 kg
-            t13 = -0.0138 # smaller v3 with age
-            t14 = 68.3 # maturation of q3
-            t15 = 2.1 # cl ref (female)
-            t16 = 1.3 # higher q2 for maturation of q3
-
-            # reference
-            age_ref = 35
-            weight_ref = 70
-            ht_ref = 170
-            with_opioids = True
-
-            # age(yrs) to pma(wks)
-            pma = age * 52 + 40
-            pma_ref = age_ref * 52 + 40
-
-            cl3_mat = _sigmoid(pma, t14, 1)
-            cl3_mat_ref = _sigmoid(pma_ref, t14, 1)
-
-            # lean body mass
-            ffm_ref = calc_lbm('M', weight_ref, ht_ref, age_ref, 'al-sallami')
-            ffm = calc_lbm(sex, weight, height, age, 'al-sallami')
-
-            v1 = t1 * (_sigmoid(weight, t12, 1) / _sigmoid(weight_ref, t12, 1))
-            v2 = t2 * (weight / weight_ref) * np.exp(t10 * (age - age_ref))
-            v3 = t3 * ffm / ffm_ref
-            if with_opioids:
-                v3 *= np.exp(t13 * age)
-            cl1 = (t4 if sex == 'M' else t15) * ((weight / weight_ref) ** 0.75)
-            cl1 *= _sigmoid(pma, t8, t9) / _sigmoid(pma_ref, t8, t9)  # age maturation
-            if with_opioids:
-                cl1 *= np.exp(t11 * age)
-            cl2 = t5 * (v2 / t2) ** 0.75 * (1 + t16 * (1 - cl3_mat))
-            cl3 = t6 * (v3 / t3) ** 0.75 * (cl3_mat / cl3_mat_ref)
-            ke0 = 0.146 * ((weight / weight_ref) ** -0.25)
-
-            self.setq(v1, v2, v3, cl1, cl2, cl3, ke0)
-        elif name == 'minto':
-            # Minto et al. Influence of age and gender on the pharmacokinetics and pharmacodynamicsof remifentanil. I. Model development. Anesthesiology, 86:10–23, 1997.
-            lbm = calc_lbm(sex, weight, height, 'james')
-            self.setq(5.1 - 0.0201 * (age - 40) + 0.072 * (lbm - 55),
-                9.82 - 0.0811 * (age - 40) + 0.108 * (lbm - 55),
-                5.42,
-                2.6 - 0.0162 * (age - 40) + 0.0191 * (lbm - 55),
-                2.05 - 0.0301 * (age - 40),
-                0.076 - 0.00113 * (age - 40),
-                0.595 - 0.007 * (age - 40))
-        elif name == 'kim':  # pk model of remifentanil
-            lbm = calc_lbm(sex, weight, height, 'janmahasatian')
-            self.setq(4.76 * (weight / 74.5) ** 0.658,
-                8.4 * (lbm / 52.3) ** 0.573 - 0.0936 * (age-37),
-                4 - 0.0477 * (age-37),
-                2.77 * (weight / 74.5) ** 0.336 - 0.0149 * (age-37),
-                1.94 - 0.0280 * (age - 37),
-                0.197,
-                0.595 - 0.007 * (age - 40))  # minto's ke0
-        elif name == 'schuttler': # remimazolam
-            # Schüttler et al. Pharmacokinetics and Pharmacodynamics of Remimazolam (CNS 7056) after Continuous Infusion in Healthy Male Volunteers: Part I. Pharmacokinetics and Clinical Pharmacodynamics. Anesthesiology. 2020 Apr;132(4):636-651.
-            self.setq(4.7 * weight / 75, 14.5, 15.5, 
-                1.14, 1.04, 0.19, 
-                0.27)
-        elif name == 'schmith':
-            # Zhou et al. Population pharmacokinetic/pharmacodynamic modeling for remimazolam in the induction and maintenance of general anesthesia in healthy subjects and in surgical subjects. J Clin Anesth. 2020
-            v1 = 2.92 * weight / 70
-            v2 = 19.1 * weight / 70
-            # if asa3:
-            #     v1 *= 1 - 0.56
-            #     v2 *= 1.22
-            v3 = 9.81 * weight / 70
-            cl1 = 61.6 * weight / 70 * (1.11 if sex == 'F' else 1) / 60
-            cl2 = 22.9 * weight / 70 / 60
-            cl3 = 69.6 * weight / 70 / 60
-            ke0 = 8.08 / 60
-            bmi = weight / (height / 100) ** 2
-            if bmi > 25:
-                ke0 *= 1.17
-            # if asian: self.ke0 *= 1 - 0.48            
-            self.setq(v1, v2, v3, cl1, cl2, cl3, ke0)
-        elif name == 'wierda':  # rocuronium
-            self.setk(45 * weight / 1000, 0.1, 0.21, 0.028, 0.13, 0.01, 0.168)
-        elif name == 'cooper':  # rocuronium
-            self.setk(38.5 * weight / 1000, 0.119, 0.259, 0.06, 0.163, 0.012, 0.168)
-        elif name == 'saldien':  # rocuronium
-            self.setk(35.6 * weight / 1000, 0.126, 0.209, 0.05, 0.163, 0.015, 0.168)
-        elif name in ('dehaes', 'de haes'):  # rocuronium
-            self.setk(42.0 * weight / 1000, 0.0762, 0.124, 0.0214, 0.13, 0.013, 0.15)
-        elif name == 'gepts': # sufentanil
-            self.setq(14.3, 63.1, 261.6, 0.92, 1.55, 0.33, ke0) # 10.1097/00000542-199512000-00010
-            
-            #self.ke0 = self.recalc_ke0(5.6 * 60) # 0.176/min = 10.1097/00000542-199101000-00010 (Shafer/Varvel 1991)
-            # the ke0 value above is wrong based on the https://blog.tivatrainer.com/sufentanil-another-mistake-in-the-implementation-in-commercial-target-controlled-infusion-systems
-
-            #self.ke0 = 0.119  # this value is from the stanpump code, but it is not clear where it comes from
-            self.ke0 = 0.112  # Implementation of Gepts model in Fresenius Base Primea, Scott, Cooke, & Stanski, 1991, K for half life = 6.2 min
-        elif name == 'hannivoort': # dexemedetomidine
-            # 10.1097/ALN.0000000000000740
-            self.setq(1.78 * (weight / 70), 30.3 * (weight / 70), 52.0 * (weight / 70),
-                      0.686 * (weight / 70) ** 0.75, 2.98 * (weight / 70) ** 0.75, 0.602 * (weight / 70) ** 0.75)
-            self.ke0 = 0.120 # 10.1093/bja/aex085 (Colin et al. 2017)
-        elif name == 'scott': # fentanyl 
-            # # k = 0.693 / hl
-            # # vd = cl * hl / 0.693
-            # hl2 = 1.0 # min
-            # hl3 = 18.5 # min
-            # q1 = 0.574 # L/min
-            # q2 = 4.005 # L/min
-            # q3 = 1.952 # L/min
-            # v1 = 12.7
-            # v2 = q2 * hl2 / 0.693 # = np.log(2)
-            # v3 = q3 * hl3 / 0.693 # = np.log(2)
-            # self.setq(v1, v2, v3, q1, q2, q3) # 1987, J Pharmacol Exp Ther 1987 Jan;240(1):159-166
-            
-            self.setk(12.7, .056, .373, .180, .096, .0077) # from stanpump code
-            # = self.setq(12.7, 49.34, 296.88, 0.71, 4.74, 2.29) # from pkpdtools.com
-            self.ke0 = 0.693 / 4.7 # 4.7 min half life
-        # elif name == 'shafer': # fentanyl (unweighted)
-        #     self.setq(6.09, 28.1, 228, .504, 2.87, 1.37) # Anesthesiology. 1990;73:1091-102. 10.1097/00000542-199012000-00005
-        #     self.ke0 = self.recalc_ke0(3.6 * 60) # 10.1097/00000542-199101000-00010 (Shafer/Varvel 1991)
-        # elif name in ('mcclain', 'hug'): # fentanyl
-        #     self.setk(0.356 * weight, 0.041, 0.185, 0.141, 0.103, 0.020)
-        #     self.ke0 = self.recalc_ke0(3.6 * 60) # 10.1097/00000542-199101000-00010 (Shafer/Varvel 1991)
+        elif name in registry:
+            self.setk(*_params(name, age, sex, weight, height))
         else:
             raise ValueError('unsupported model')
 
@@ -214,27 +50,47 @@ class Model:
         self.k21 = k21
         self.k31 = k31
         self.ke0 = ke0
+        self._cache_key = None
+
+    def _cached(self, key, func):
+        '''
+        per-model cache of the derived arrays (udf, decay responses)
+        invalidated whenever setk/setq is called or any parameter (e.g. ke0) is changed
+        key: name of the cached item
+        func: function that generates the item
+        '''
+        params = (self.v1, self.k10, self.k12, self.k13, self.k21, self.k31, self.ke0, self.method)
+        if getattr(self, '_cache_key', None) != params:
+            self._cache_key = params
+            self._cache = {}
+        if key not in self._cache:
+            ret = func()
+            ret.flags.writeable = False
+            self._cache[key] = ret
+        return self._cache[key]
 
-    def cp(self, tmax=None, dose=None, a=None):
+    def cp(self, tmax=None, dose=None, a=None, method=None, dt=None):
         '''
         calculate the plasma concentration
         '''
-        return self.sim(tmax, dose, a)[:, 0] / self.v1
+        return self.sim(tmax, dose, a, method=method, dt=dt)[:, 0] / self.v1
 
-    def ce(self, tmax=None, dose=None, a=None, ke0=None):
+    def ce(self, tmax=None, dose=None, a=None, ke0=None, method=None, dt=None):
         '''
         calculate the effect site concentration
         '''
-        return self.sim(tmax, dose, a, ke0)[:, 3] / self.v1 * self.v1_v4
+        return self.sim(tmax, dose, a, ke0, method=method, dt=dt)[:, 3] / self.v1 * self.v1_v4
     
-    def sim(self, tmax=None, dose=None, a=None, ke0=None):
+    def sim(self, tmax=None, dose=None, a=None, ke0=None, method=None, dt=None):
         '''
         simulate the movement of drug amount in the compartments
         tmax: maximum time in seconds for simulation (if None, do while the maximum Ce is reached)
-        dose: infused amount at every second ([1] for bolus at time 0, [1] * 10 for infusion for 10 sec, etc.)
+        dose: infusion rate (amount per second) at every step ([1] for bolus at time 0, [1] * 10 for infusion for 10 sec, etc.)
         ke0: the elimination rate from the effect site (if None, use the self.ke0)
         a: initial state of the compartments
-        returns: the estimated amount of drugs in the compartments in the shape (tmax, 4)
+        method: 'euler' or 'exact' (if None, use the self.method)
+        dt: time step in seconds (if None, use the self.dt)
+        returns: the estimated amount of drugs in the compartments at the end of every step in the shape (tmax / dt, 4)
         '''
         ret = []
 
@@ -253,167 +109,1008 @@ class Model:
         if ke0 is None:
             ke0 = self.ke0
 
+        if dt is None:
+            dt = self.dt
+        peak = tmax == 9999  # when user wants do until maximum Ce is reached
+        tmax = int(round(tmax / dt))  # number of steps
+
+        if method is None:
+            method = self.method
+        if method == 'exact':
+            return self._sim_exact(tmax, dose, a, ke0, dt, peak)
+        elif method != 'euler':
+            raise ValueError('unsupported method')
+
         # generate update matrix
         k = np.array([
-            [1 - (self.k10 + self.k12 + self.k13) / 60, self.k21 / 60, self.k31 / 60, 0],
-            [self.k12 / 60, 1 - self.k21 / 60, 0, 0],
-            [self.k13 / 60, 0, 1 - self.k31 / 60, 0],
-            [ke0 / self.v1_v4 / 60, 0, 0, 1 - ke0 / 60]
+            [1 - (self.k10 + self.k12 + self.k13) / 60 * dt, self.k21 / 60 * dt, self.k31 / 60 * dt, 0],
+            [self.k12 / 60 * dt, 1 - self.k21 / 60 * dt, 0, 0],
+            [self.k13 / 60 * dt, 0, 1 - self.k31 / 60 * dt, 0],
+            [ke0 / self.v1_v4 / 60 * dt, 0, 0, 1 - ke0 / 60 * dt]
         ])
 
         # simulation
         for i in range(tmax):
             a = np.matmul(k, a)  # natural decay
             if i < len(dose):
-                a[0] += dose[i]  # infusion
-            if tmax == 9999:  # when user wants do until maximum Ce is reached
+                a[0] += dose[i] * dt  # infusion
+            if peak:
                 if a[3] < last_a4:
                     break
                 last_a4 = a[3]
             ret.append(a)
 
         return np.array(ret)
+
+    def _sim_exact(self, tmax, dose, a, ke0, dt=1, peak=False):
+        '''
+        closed-form counterpart of sim()
+        the dose of each step is infused at a constant rate during that step
+        and every run of equal doses is evaluated in a single step
+        tmax: number of steps
+        '''
+        mu, h, v, vinv = _modes(self.k10, self.k12, self.k13, self.k21, self.k31, ke0, self.v1_v4, 'exact', dt)
+
+        d = np.zeros(tmax)
+        n = min(len(dose), tmax)
+        d[:n] = dose[:n]
+
+        z = vinv @ a
+        zs = np.empty((tmax, 4), dtype=np.result_type(z, mu))
+        starts = np.r_[0, np.flatnonzero(np.diff(d)) + 1]
+        ends = np.r_[starts[1:], tmax]
+        for s, e in zip(starts, ends):
+            if s < e:
+                zs[s:e] = _steps(z, d[s], e - s, mu, h)
+                z = zs[e - 1]
+        ret = (zs @ v.T).real
+
+        if peak:  # when user wants do until maximum Ce is reached
+            a4 = ret[:, 3]
+            stop = np.flatnonzero(a4 < np.r_[0, a4[:-1]])
+            if len(stop):
+                ret = ret[:stop[0]]
+
+        return ret
     
-    def tpeak(self, ke0=None, prec=1):
+    def tpeak(self, ke0=None, prec=None):
         '''
-        estimate the time to reach the maximum effect site concentration
-        ke0: the elimination rate from the effect site (if None, use the self.ke0)
-        prec: the precision of the time in seconds
+        estimate the time to reach the maximum effect site concentration after a bolus
+        ke0: the elimination rate from the effect site (if None, use the self.ke0), scalar or array
+        prec: if given, simulate the bolus with the time step of prec seconds instead of the analytical solution
+        returns: time to peak in seconds
         '''
         if ke0 is None:
             ke0 = self.ke0
-        model = Model(v1=self.v1, k10=self.k10 * prec, k12=self.k12 * prec, k13=self.k13 * prec, k21=self.k21 * prec, k31=self.k31 * prec, ke0=ke0 * prec)
-        tpeak = len(model.ce(dose=1, ke0=ke0 * prec)) * prec
-        return tpeak
+        if prec is None:
+            tpeak = _tpeak(self.k10, self.k12, self.k13, self.k21, self.k31, ke0)
+            return tpeak if np.ndim(tpeak) else float(tpeak)
+        return len(self.ce(dose=1 / prec, ke0=ke0, method='euler', dt=prec)) * prec
     
     def recalc_ke0(self, tpeak):
         '''
-        find optimal ke0 that minimize the difference between the estimated tpeak and the actual tpeak
-        tpeak: the actual time to reach the maximum effect in seconds
+        find optimal ke0 that makes the analytical time to peak effect equal to the actual tpeak
+        tpeak: the actual time to reach the maximum effect in seconds, scalar or array
         returns: the optimal ke0 in /min
         '''
-        return optimize.brentq(lambda ke0, tpeak: self.tpeak(ke0, prec=0.1) - tpeak, a=1e-5, b=100, args=(tpeak))
+        ke0 = _recalc_ke0(self.k10, self.k12, self.k13, self.k21, self.k31, tpeak)
+        return ke0 if np.ndim(ke0) else float(ke0)
     
-    def udf(self, plasma=False):
+    def _decay_coef(self, a, plasma):
+        '''
+        exponents and coefficients of the concentration without infusion from the state a
+        c(t) = sum(coef * exp(lam * t)) with t in seconds
+        '''
+        lam, v, vinv = _eig_cached(self.k10, self.k12, self.k13, self.k21, self.k31, self.ke0, self.v1_v4)
+        if a is None:
+            a = np.zeros(4)
+        out = v[0] / self.v1 if plasma else v[3] / self.v1 * self.v1_v4
+        return lam, out * (np.asarray(a, dtype=float) @ vinv.T)
+
+    def forecast(self, t, a=None, plasma=False):
+        '''
+        analytical concentration after t seconds if the infusion is stopped
+        t: seconds from now, scalar or array
+        a: the current state of the compartments in the shape (4,) or (..., 4) for many states
+        returns: the effect site (or plasma) concentrations in the broadcast shape of t and a[..., 0]
+        '''
+        lam, coef = self._decay_coef(a, plasma)
+        return _exp_sum(lam, coef, t)
+
+    def decrement_time(self, c, a=None, plasma=False):
+        '''
+        analytical time in seconds until the concentration falls to c if the infusion is stopped
+        (e.g. the wake-up time for the effect site concentration of awakening, the context-sensitive half-time for c = half of the current plasma concentration)
+        c: the concentration, scalar or array
+        a: the current state of the compartments in the shape (4,) or (..., 4) for many states
+        returns: the seconds in the broadcast shape of c and a[..., 0] (0 if it does not exceed c, inf if it never falls to c)
+        '''
+        lam, coef = self._decay_coef(a, plasma)
+        ret = _decrement_time(lam, coef, c)
+        return ret if np.ndim(ret) else float(ret)
+
+    def udf(self, plasma=False, dt=None):
         '''
         generate the unit disposition function (UDF) for the plasma or the effect site
+        the response to the infusion of 1 per second for 10 sec at every step of dt seconds
+        the result is cached until the parameters of the model are changed
         '''
+        if dt is None:
+            dt = self.dt
+        dose = [1] * _nsteps(10, dt)
         if plasma:
-            return self.cp(10, dose=[1]*10) # always maximum at 10 sec
+            return self._cached(('udf_plasma', dt), lambda: self.cp(10, dose=dose, dt=dt)) # always maximum at 10 sec
         else:  # effect site
-            return self.ce(dose=[1]*10)
+            return self._cached(('udf', dt), lambda: self.ce(dose=dose, dt=dt))
 
-    def tci(self, ct, a=None, plasma=False):
+    def decay(self, plasma=False, dt=None):
+        '''
+        free decay responses of the plasma or the effect site concentration for the duration of the udf
+        returns: array in the shape (len(udf), 4) and decay(plasma) @ a equals cp(len(udf) * dt, a=a) or ce(len(udf) * dt, a=a)
+        '''
+        if dt is None:
+            dt = self.dt
+        def calc():
+            n = len(self.udf(plasma=plasma, dt=dt))
+            amounts = np.stack([self.sim(n * dt, a=a0, dt=dt) for a0 in np.eye(4)], axis=-1)  # (n, compartment, initial unit amount)
+            if plasma:
+                return amounts[:, 0, :] / self.v1
+            return amounts[:, 3, :] / self.v1 * self.v1_v4
+        return self._cached(('decay_plasma' if plasma else 'decay', dt), calc)
+
+    tol = 0.001  # relative tolerance of the predicted peak to the target in tci
+    maxiter = 20  # maximum number of the iterations in tci
+    tci_log = None  # set to a list to record (target, iterations, seconds) of every tci call
+    def tci(self, ct, a=None, plasma=False, tol=None, maxiter=None, full_output=False, dt=None):
         '''
         calculate the infusion rate to achieve the desired effect site concentration using the Shafer and Greg algorithm
         a: the initial state of the compartments
         ct: target concentration
+        tol: relative tolerance of the predicted peak to the target (if None, use the self.tol)
+            if 0, the peak time is found directly as the time that needs the lowest rate to reach the target
+        maxiter: maximum number of the iterations before the direct solution is used (if None, use the self.maxiter)
+        full_output: if True, also return the number of the iterations
+        dt: time step in seconds (if None, use the self.dt)
+        returns: (rate, tpeak) or (rate, tpeak, niter) where the rate is per second and tpeak is in steps
         '''
+        if self.tci_log is not None:
+            start = time.perf_counter()
         if a is None:
             a = np.zeros(4)
+        if tol is None:
+            tol = self.tol
+        if maxiter is None:
+            maxiter = self.maxiter
         
-        # generate udf
-        udf = self.udf(plasma=plasma)
+        # cached udf and free decay responses
+        udf = self.udf(plasma=plasma, dt=dt)
+        b = self.decay(plasma=plasma, dt=dt) @ a  # natural decay
+        rate, tpeak, niter = _tci(ct, b, udf, tol, maxiter)
 
-        tpeak = len(udf)-1  # initial tpeak
-        while True:
-            # natural decay
-            if plasma:
-                b = self.cp(tpeak + 1, a=a)
-            else:  # effect site
-                b = self.ce(tpeak + 1, a=a)
-
-            if b[0] > ct: # if the current effect site concentration is higher than the target
-                if b[-1] < ct: # wait until the effect site concentration is lower than the target
-                    return 0, np.where(b < ct)[0][0]
-                return 0, tpeak
-            
-            rate = (ct - b[-1]) / udf[tpeak]
-            c = b + udf[:len(b)] * rate
-            new_tpeak = np.argmax(c)
-            if new_tpeak == tpeak or abs(c[new_tpeak] - ct) <= ct * 0.001:
-                break
-            tpeak = new_tpeak
+        if self.tci_log is not None:
+            self.tci_log.append((ct, niter, time.perf_counter() - start))
+        if full_output:
+            return rate, tpeak, niter
         return rate, tpeak
     
-    def run(self, cts, filename=None, maxrate=None, plasma=False):
+    columns = ('Ct', 'Cp', 'Ce', 'Rate', 'Infused')
+    def _run(self, cts, maxrate=None, plasma=False, event=False, tmax=None, dt=None):
         '''
-        simulate the movement of drug amount in the compartments
-        returns: DataFrame of Ct, Cp, Ce, and Rate
-        '''
-        last_ct = 0
-        wait_until = 0
-        infuse_until = 0
-        ces = []
-        cps = []
-        rates = []
+        TCI simulation of run() without the DataFrame
+        returns: array in the shape (len(cts), 5) of the columns Ct, Cp, Ce, Rate, Infused
+        '''
+        if dt is None:
+            dt = self.dt
+        if event or np.ndim(cts) == 2:
+            return self._run_events(*_changepoints(cts, tmax, dt), maxrate, plasma, dt)
+
+        state = _decision_state()
+        ret = np.empty((len(cts), 5))
         a = np.zeros(4) # initial state
         for i in range(len(cts)):
             ct = cts[i]
-            if i >= wait_until or ct != last_ct:
-                last_ct = ct
-                rate, tpeak = self.tci(cts[i], a, plasma=plasma)
-                infuse_until = i + 10
-                if maxrate and rate > maxrate:
-                    rate = maxrate
-                    wait_until = i + 10
-                else:
-                    wait_until = i + tpeak + 1
-            if i >= infuse_until:
-                rate = 0
-            a = self.sim(1, dose=rate, a=a)[-1]
-            rates.append(rate)
-            cps.append(a[0] / self.v1)
-            ces.append(a[3] / self.v1 * self.v1_v4)
-        
-        df = pd.DataFrame({'Ct': cts, 'Cp': cps, 'Ce': ces, 'Rate': rates, 'Infused': np.cumsum(rates)})
-        if filename:
+            _decide(self, i, ct, state, lambda: a, maxrate, plasma, dt)
+            rate = state['rate']
+            a = self.sim(dt, dose=rate, a=a, dt=dt)[-1]
+            ret[i, :4] = ct, a[0] / self.v1, a[3] / self.v1 * self.v1_v4, rate
+        ret[:, 4] = np.cumsum(ret[:, 3]) * dt
+        return ret
+
+    def _run_events(self, times, targets, tmax, maxrate=None, plasma=False, dt=1):
+        '''
+        event-driven version of _run()
+        the rate is decided only at the target changes and when the infusion or the waiting time is over
+        and the compartments are propagated in closed form between these events
+        times: the steps when the target is changed (sorted)
+        targets: the target concentrations from the times
+        tmax: duration of the simulation in steps
+        dt: time step in seconds
+        '''
+        mu, h, v, vinv = _modes(self.k10, self.k12, self.k13, self.k21, self.k31, self.ke0, self.v1_v4, self.method, dt)
+        out = v[[0, 3]].T / self.v1 * np.array([1, self.v1_v4])  # modal states to Cp and Ce
+
+        ret = np.zeros((tmax, 5))
+        ends = np.r_[times[1:], tmax]
+        for t, e, ct in zip(times, ends, targets):
+            ret[t:e, 0] = ct
+
+        z = np.zeros(4, dtype=mu.dtype)  # modal initial state
+        state = _decision_state()
+        k = 0  # index of the next target change
+        i = 0
+        while i < tmax:
+            while k < len(times) and times[k] <= i:
+                k += 1
+            nxt = min(tmax, i + _decide(self, i, ret[i, 0], state, lambda: (v @ z).real, maxrate, plasma, dt))
+            rate = state['rate']
+
+            # propagate until the next event
+            if k < len(times):
+                nxt = min(nxt, times[k])
+            z, ret[i:nxt, 1:3] = _segment(z, rate, nxt - i, mu, h, out, self.method == 'euler')
+            ret[i:nxt, 3] = rate
+            i = nxt
+        ret[:, 4] = np.cumsum(ret[:, 3]) * dt
+        return ret
+
+    def run(self, cts, filename=None, maxrate=None, plasma=False, event=False, tmax=None, return_type='dataframe', dt=None, plot=False, sink=None):
+        '''
+        simulate the movement of drug amount in the compartments
+        cts: target concentration at every step or the list of (time in seconds, target concentration) at the target changes
+        filename: csv file to save the results
+        plot: if True, plot the concentrations to filename + '.png' (or show the plot without filename)
+        sink: ResultWriter or the directory to write the columns of the results in a binary format (see ResultWriter)
+        event: if True, use the event-driven simulation (always used for the list of target changes)
+        tmax: duration in seconds for the list of target changes (if None, 1 hour after the last change)
+        return_type: 'dataframe' or 'numpy' for the structured array without importing pandas
+        dt: time step in seconds (if None, use the self.dt)
+        returns: DataFrame or structured array of Ct, Cp, Ce, Rate (per second), and Infused at every step
+        '''
+        if return_type not in ('dataframe', 'numpy'):
+            raise ValueError('unsupported return_type')
+        ret = self._run(cts, maxrate, plasma, event, tmax, dt)
+        if np.ndim(cts) == 2:
+            cts = ret[:, 0]
+        cps = ret[:, 1]
+        ces = ret[:, 2]
+        if sink is not None:
+            writer, owned = _open_sink(sink, self.columns)
+            writer.write(ret)
+            if owned:
+                writer.close()
+        df = None
+        if return_type == 'dataframe' or filename:
+            import pandas as pd
+            df = pd.DataFrame({'Ct': cts, 'Cp': cps, 'Ce': ces, 'Rate': ret[:, 3], 'Infused': ret[:, 4]})
+        if plot:
+            import matplotlib.pyplot as plt
             plt.figure(figsize=(20, 5))
             plt.plot(cps, color='red', label='Cp')
             plt.plot(cts, color='blue', label='Ct')
             plt.plot(ces, color='green', label='Ce')
             plt.legend()
-            plt.savefig(filename + '.png')
+            if filename:
+                plt.savefig(filename + '.png')
+            else:
+                plt.show()
+        if filename:
             df.to_csv(filename, index=False)
         
+        if return_type == 'numpy':
+            return ret.view([(col, ret.dtype) for col in self.columns])[:, 0]
         return df
+
+    def __getstate__(self):
+        # the cached arrays are rebuilt on demand rather than pickled
+        state = self.__dict__.copy()
+        state.pop('_cache', None)
+        state.pop('_cache_key', None)
+        return state
     
     def __repr__(self):
         return f'Model(v1={self.v1:.2f}, k10={self.k10:.4f}, k12={self.k12:.4f}, k13={self.k13:.4f}, k21={self.k21:.4f}, k31={self.k31:.4f}, ke0={self.ke0:.4f})'
 
+@functools.lru_cache(maxsize=1024)
+def _modes(k10, k12, k13, k21, k31, ke0, v1_v4, method='exact', dt=1):
+    '''
+    eigendecomposition of the update of the compartments for one step of dt seconds
+    a(t+dt) = v @ (mu * (vinv @ a(t)) + h * dose) where dose is the infusion rate per second
+    method: 'exact' for the matrix exponential of the rate matrix, 'euler' for the forward euler matrix
+    returns: (mu, h, v, vinv)
+    '''
+    lam, v, vinv = _eig(k10, k12, k13, k21, k31, ke0, v1_v4, dt)
+    mu, h = _discretize(lam, vinv, method, dt)
+    return mu, h, v, vinv
+
+
+def _eig(k10, k12, k13, k21, k31, ke0, v1_v4, dt=1):
+    '''
+    eigendecomposition of the rate matrix of the compartments in step^-1 for the steps of dt seconds (vectorized)
+    the arguments are scalars or arrays in the same shape
+    returns: (lam, v, vinv) in the shape (..., 4), (..., 4, 4), (..., 4, 4)
+    '''
+    k10, k12, k13, k21, k31, ke0 = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (k10, k12, k13, k21, k31, ke0)])
+    shape = k10.shape
+    k10, k12, k13, k21, k31 = [np.ravel(x) for x in (k10, k12, k13, k21, k31)]
+    ke0 = np.ravel(ke0).copy()
+    k = np.zeros((len(k10), 4, 4))
+    k[:, 0, 0] = -(k10 + k12 + k13)
+    k[:, 0, 1] = k21
+    k[:, 0, 2] = k31
+    k[:, 1, 0] = k12
+    k[:, 1, 1] = -k21
+    k[:, 2, 0] = k13
+    k[:, 2, 2] = -k31
+    k[:, 3, 0] = ke0 / v1_v4
+    k[:, 3, 3] = -ke0
+    k = k / 60 * dt
+    lam, v = np.linalg.eig(k)
+    for _ in range(10):
+        # ke0 coincides with one of the pk eigenvalues and the matrix is (nearly) defective
+        bad = np.flatnonzero((np.linalg.cond(v) > 1e8) & (ke0 != 0))
+        if not len(bad):
+            break
+        ke0[bad] *= 1 + 1e-6
+        k[bad, 3, 0] = ke0[bad] / v1_v4 / 60 * dt
+        k[bad, 3, 3] = -ke0[bad] / 60 * dt
+        lam[bad], v[bad] = np.linalg.eig(k[bad])
+    return lam.reshape(shape + (4,)), v.reshape(shape + (4, 4)), np.linalg.inv(v).reshape(shape + (4, 4))
+
+
+def _discretize(lam, vinv, method, dt=1):
+    '''
+    modal update for one step from the eigendecomposition of _eig (vectorized)
+    method: 'exact' for the matrix exponential of the rate matrix, 'euler' for the forward euler matrix
+    returns: (mu, h) in the shape of lam
+    '''
+    if method == 'euler':
+        mu = 1 + lam
+        h = vinv[..., :, 0] * dt
+    elif method == 'exact':
+        mu = np.exp(lam)
+        # integral of exp(lam * t) over one step for a constant infusion
+        nz = lam != 0
+        ratio = np.ones_like(lam)
+        ratio[nz] = np.expm1(lam[nz]) / lam[nz]
+        h = vinv[..., :, 0] * ratio * dt
+    else:
+        raise ValueError('unsupported method')
+    return mu, h
+
+
+def _nsteps(seconds, dt):
+    '''
+    number of the steps of dt seconds in the given seconds (at least 1)
+    '''
+    return max(1, int(round(seconds / dt)))
+
+
+def _steps(z, dose, n, mu, h):
+    '''
+    modal states after each of n steps with a constant dose from the modal state z
+    returns: array in the shape (n, len(z))
+    '''
+    i = np.arange(1, n + 1)[:, None]
+    p = mu ** i
+    one = mu == 1
+    s = np.where(one, i, (1 - p) / np.where(one, 1, 1 - mu))  # sum of mu ** j for j < i
+    return p * z + s * (h * dose)
+
+
+def _segment(z, dose, n, mu, h, out, euler=False):
+    '''
+    propagate the modal states for n steps with a constant dose and map them to the concentrations
+    z, mu, h: modal states and updates of one or more drugs (4 modes per drug) concatenated
+    dose: the infusion rate, a scalar or an array in the shape of z
+    out: matrix from the modal states to Cp and Ce in the shape (len(z), 2 * number of drugs)
+    euler: True for the drugs (a scalar or one per drug) simulated with the euler method
+    returns: (modal states after n steps, concentrations in the shape (n, 2 * number of drugs))
+    '''
+    zs = _steps(z, dose, n, mu, h)
+    conc = np.maximum((zs @ out).real, 0)  # no rounding below 0 from the empty compartments
+    # as sim: the effect site is fed by the previous central amount, which is 0 for the empty compartments
+    empty = np.asarray(euler) & ~z.reshape(-1, 4).any(axis=1)
+    conc[0, 1::2][empty] = 0
+    return zs[-1], conc
+
+
+def _pk_modes(k10, k12, k13, k21, k31):
+    '''
+    exponents and coefficients of the central amount after a unit bolus
+    a1(t) = sum(coef * exp(lam * t)) with t in min
+    the arguments are scalars or arrays in the same shape
+    returns: (lam, coef) in the shape (..., 3)
+    '''
+    k10, k12, k13, k21, k31 = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (k10, k12, k13, k21, k31)])
+    k = np.zeros(k10.shape + (3, 3))
+    k[..., 0, 0] = -(k10 + k12 + k13)
+    k[..., 0, 1] = k21
+    k[..., 0, 2] = k31
+    k[..., 1, 0] = k12
+    k[..., 1, 1] = -k21
+    k[..., 2, 0] = k13
+    k[..., 2, 2] = -k31
+    lam, v = np.linalg.eig(k)  # real for the mammillary models
+    coef = v[..., 0, :] * np.linalg.inv(v)[..., :, 0]
+    return lam.real, coef.real
+
+
+def _peak_gap(lam, coef, ke0, t):
+    '''
+    difference between the plasma and the effect site concentrations after a unit bolus
+    the effect site concentration is at its peak when it is zero (dCe/dt = ke0 * (Cp - Ce))
+    lam, coef: from _pk_modes in the shape (..., 3)
+    ke0, t: in /min and min in the shape (...)
+    '''
+    ke0 = ke0[..., None]
+    t = t[..., None]
+    e = np.exp(lam * t)
+    d = ke0 + lam
+    near = np.abs(d) < 1e-9 * np.maximum(ke0, 1e-9)
+    ce = np.where(near, ke0 * t * np.exp(-ke0 * t), ke0 * (e - np.exp(-ke0 * t)) / np.where(near, 1, d))
+    return np.sum(coef * (e - ce), axis=-1)
+
+
+def _tpeak(k10, k12, k13, k21, k31, ke0):
+    '''
+    analytical time to the peak effect site concentration after a bolus (vectorized)
+    the first root of Cp(t) = Ce(t) is bracketed on a doubling grid and refined by bisection
+    returns: time to peak in seconds (nan if the effect site concentration has no peak)
+    '''
+    lam, coef = _pk_modes(k10, k12, k13, k21, k31)
+    ke0 = np.asarray(ke0, dtype=float)
+    shape = np.broadcast_shapes(lam.shape[:-1], ke0.shape)
+    lam, coef = np.broadcast_to(lam, shape + (3,)), np.broadcast_to(coef, shape + (3,))
+    ke0 = np.broadcast_to(ke0, shape)
+    lo = np.zeros(ke0.shape)
+    hi = np.full(ke0.shape, 1 / 60)  # 1 sec
+    for _ in range(40):
+        rising = _peak_gap(lam, coef, ke0, hi) > 0
+        if not rising.any():
+            break
+        lo = np.where(rising, hi, lo)
+        hi = np.where(rising, hi * 2, hi)
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        rising = _peak_gap(lam, coef, ke0, mid) > 0
+        lo = np.where(rising, mid, lo)
+        hi = np.where(rising, hi, mid)
+    tpeak = (lo + hi) / 2 * 60
+    return np.where(_peak_gap(lam, coef, ke0, hi) > 0, np.nan, tpeak)
+
+
+def _recalc_ke0(k10, k12, k13, k21, k31, tpeak, lo=1e-5, hi=100):
+    '''
+    ke0 that makes the analytical tpeak equal to the given tpeak (vectorized)
+    at the peak Cp = Ce, and Ce at that time increases with ke0, so ke0 is found by bisection on log(ke0)
+    tpeak: time to peak in seconds
+    returns: ke0 in /min (nan if it is not in [lo, hi])
+    '''
+    lam, coef = _pk_modes(k10, k12, k13, k21, k31)
+    t = np.asarray(tpeak, dtype=float) / 60
+    shape = np.broadcast_shapes(lam.shape[:-1], t.shape)
+    lam, coef = np.broadcast_to(lam, shape + (3,)), np.broadcast_to(coef, shape + (3,))
+    t = np.broadcast_to(t, shape)
+    lo = np.full(shape, np.log(lo))
+    hi = np.full(shape, np.log(hi))
+    valid = (_peak_gap(lam, coef, np.exp(lo), t) > 0) & (_peak_gap(lam, coef, np.exp(hi), t) < 0)
+    for _ in range(80):
+        mid = (lo + hi) / 2
+        slow = _peak_gap(lam, coef, np.exp(mid), t) > 0  # the peak is after tpeak
+        lo = np.where(slow, mid, lo)
+        hi = np.where(slow, hi, mid)
+    return np.where(valid, np.exp((lo + hi) / 2), np.nan)
+
+
+@functools.lru_cache(maxsize=1024)
+def _eig_cached(k10, k12, k13, k21, k31, ke0, v1_v4):
+    return _eig(k10, k12, k13, k21, k31, ke0, v1_v4)
+
+
+def _exp_sum(lam, coef, t, order=0):
+    '''
+    sum(coef * lam ** order * exp(lam * t)) over the last axis, the order-th derivative of the sum of exponentials
+    '''
+    t = np.asarray(t, dtype=float)[..., None]
+    return np.sum(coef * lam ** order * np.exp(lam * t), axis=-1).real
+
+
+def _falling_root(lam, coef, c, lo, hi, order=0, tol=1e-6, maxiter=100):
+    '''
+    root of the sum of exponentials (see _exp_sum) which is above c at lo and below c at hi (vectorized)
+    newton steps are taken when they stay in the bracket and bisection steps otherwise
+    '''
+    coef = coef * lam ** order
+    t = lo.copy()
+    for _ in range(maxiter):
+        terms = coef * np.exp(lam * t[..., None])
+        f = np.add.reduce(terms, axis=-1).real - c
+        above = f > 0
+        lo = np.where(above, t, lo)
+        hi = np.where(above, hi, t)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new = t - f / np.add.reduce(terms * lam, axis=-1).real
+        bad = ~((new > lo) & (new < hi))
+        new[bad] = (lo[bad] + hi[bad]) / 2
+        done = np.abs(new - t) <= tol
+        t = new
+        if done.all():
+            break
+    return t
+
+
+def _decrement_time(lam, coef, c):
+    '''
+    time in seconds until the concentration sum(coef * exp(lam * t)) falls to c and stays below it (vectorized)
+    without infusion the concentration has at most one peak and decreases after it,
+    so the peak is found first if it is rising, then the crossing of c after the peak
+    lam, coef: in the shape (..., 4)
+    returns: seconds (0 if it does not exceed c, inf if it never falls to c)
+    '''
+    c = np.asarray(c, dtype=float)
+    shape = np.broadcast_shapes(lam.shape[:-1], coef.shape[:-1], c.shape)
+    lam = np.broadcast_to(lam, shape + (4,))
+    coef = np.broadcast_to(coef, shape + (4,))
+    c = np.broadcast_to(c, shape)
+    slowest = lam.real.max(axis=-1)
+
+    # the peak
+    start = np.zeros(shape)
+    rising = _exp_sum(lam, coef, start, 1) > 0
+    if rising.any():
+        lo = start[rising]
+        hi = np.full(lo.shape, 60.)
+        l, k = lam[rising], coef[rising]
+        for _ in range(40):
+            up = _exp_sum(l, k, hi, 1) > 0
+            if not up.any():
+                break
+            lo = np.where(up, hi, lo)
+            hi = np.where(up, hi * 2, hi)
+        start[rising] = _falling_root(l, k, 0, lo, hi, order=1)
+
+    ret = np.zeros(shape)
+    ret[(c <= 0) | (slowest >= 0)] = np.inf
+    todo = (_exp_sum(lam, coef, start) > c) & np.isfinite(ret)
+    if todo.any():
+        l, k, cc = lam[todo], coef[todo], c[todo]
+        lo = start[todo]
+        # the concentration is below sum(|coef|) * exp(slowest * t)
+        hi = np.maximum(np.log(np.abs(k).sum(axis=-1) / cc) / -slowest[todo], lo)
+        ret[todo] = _falling_root(l, k, cc, lo, hi)
+    return ret
+
+
+def _tci(ct, b, udf, tol=0.001, maxiter=20):
+    '''
+    solve the rate of the Shafer and Greg algorithm
+    ct: target concentration
+    b: natural decay of the concentration for the duration of the udf
+    udf: unit disposition function
+    returns: (rate, tpeak, niter)
+    '''
+    tpeak = len(udf)-1  # initial tpeak
+    if b[0] > ct: # if the current effect site concentration is higher than the target
+        if b[tpeak] < ct: # wait until the effect site concentration is lower than the target
+            return 0, np.where(b < ct)[0][0], 0
+        return 0, tpeak, 0
+
+    if tol:
+        for niter in range(1, maxiter + 1):
+            rate = (ct - b[tpeak]) / udf[tpeak]
+            c = b[:tpeak + 1] + udf[:tpeak + 1] * rate
+            new_tpeak = np.argmax(c)
+            if new_tpeak == tpeak or abs(c[new_tpeak] - ct) <= ct * tol:
+                return rate, tpeak, niter
+            tpeak = new_tpeak
+    else:
+        niter = 0
+
+    # the iteration converges to the time when the lowest rate reaches the target
+    # so the concentration never exceeds the target with this rate
+    valid = udf > 0
+    rates = np.full(len(udf), np.inf)
+    rates[valid] = (ct - b[valid]) / udf[valid]
+    tpeak = np.argmin(rates)
+    return rates[tpeak], tpeak, niter + 1
+
+
+def _decision_state():
+    '''
+    initial state of _decide
+    '''
+    return {'last_ct': 0, 'rate': 0, 'wait_until': 0, 'infuse_until': 0}
+
+
+def _decide(model, i, ct, state, amounts, maxrate=None, plasma=False, dt=1):
+    '''
+    rate decision of Model.run at the step i
+    the rate is recalculated by model.tci when the target is changed or the waiting time (until the peak) is over
+    and infused for 10 sec, or with maxrate for 10 sec before the next recalculation
+    state: dict of 'last_ct', 'rate', 'wait_until' and 'infuse_until' (in steps) from _decision_state(), which is updated
+    amounts: function that returns the current state of the compartments (called only for the recalculation)
+    returns: the steps until the next decision with the same target
+    '''
+    if i >= state['wait_until'] or ct != state['last_ct']:
+        state['last_ct'] = ct
+        rate, tpeak = model.tci(ct, amounts(), plasma=plasma, dt=dt)
+        n10 = _nsteps(10, dt)  # steps of the 10 sec infusion
+        state['infuse_until'] = i + n10
+        if maxrate and rate > maxrate:
+            rate = maxrate
+            state['wait_until'] = i + n10
+        else:
+            state['wait_until'] = i + tpeak + 1
+        state['rate'] = rate
+    if i >= state['infuse_until']:
+        state['rate'] = 0
+        return state['wait_until'] - i
+    return min(state['wait_until'], state['infuse_until']) - i
+
+
+def _changepoints(cts, tmax=None, dt=1):
+    '''
+    convert the targets into the target changes
+    cts: target concentration at every step or the list of (time in seconds, target concentration)
+        the list is sorted by the time (the last of the same time is used) and the times before 0 are taken as 0
+    tmax: duration in seconds for the list of target changes (if None, 1 hour after the last change)
+    dt: time step in seconds
+    returns: (times, targets, tmax) in steps
+    '''
+    if np.ndim(cts) == 2:
+        cts = np.asarray(cts, dtype=float)
+        cts = cts[np.argsort(cts[:, 0], kind='stable')]
+        times = np.maximum(np.round(cts[:, 0] / dt).astype(int), 0)  # rounded as tmax
+        targets = cts[:, 1]
+        if tmax is None:
+            tmax = times[-1] + _nsteps(3600, dt) if len(times) else 0
+        else:
+            tmax = int(round(tmax / dt))
+        keep = times < tmax
+        return times[keep], targets[keep], tmax
+    cts = np.asarray(cts, dtype=float)
+    times = np.r_[0, np.flatnonzero(np.diff(cts)) + 1] if len(cts) else np.zeros(0, dtype=int)
+    return times, cts[times], len(cts)
+
+
 def _sigmoid(x, e50, y):
     return (x ** y) / ((x ** y) + (e50 ** y))
 
 
-def calc_lbm(sex, weight, height, age=None, model='james'):
-    if model == 'james':
+def _by_sex(sex, male, female):
+    '''
+    select the value of the sex ('M' or 'F') for scalars or arrays
+    '''
+    if np.ndim(sex) == 0:
         if sex == 'M':
-            return 1.1 * weight - 128 * (weight / height) ** 2
+            return male
         elif sex == 'F':
-            return 1.07 * weight - 148 * (weight / height) ** 2
+            return female
+        raise ValueError
+    sex = np.asarray(sex)
+    if not np.isin(sex, ('M', 'F')).all():
+        raise ValueError
+    return np.where(sex == 'M', male, female)
+
+
+def calc_lbm(sex, weight, height, age=None, model='james'):
+    '''
+    calculate the lean body mass in kg
+    the arguments can be arrays in the same shape
+    '''
+    if model == 'james':
+        return _by_sex(sex, 1.1 * weight - 128 * (weight / height) ** 2,
+                       1.07 * weight - 148 * (weight / height) ** 2)
     elif model == 'janmahasatian':
         # Janmahasatian et al. Quantification of lean bodyweight. Clin Pharmacokinet. 2005;44(10):1051-65.
         bmi = weight / (height / 100) ** 2
-        if sex == 'M':
-            return 9270 * weight / (6680 + 216 * bmi)
-        if sex == 'F':
-            return 9270 * weight / (8780 + 244 * bmi)
+        return _by_sex(sex, 9270 * weight / (6680 + 216 * bmi),
+                       9270 * weight / (8780 + 244 * bmi))
     elif model == 'devine':
         # Devine BJ. Gentamicin therapy. Drug Intell Clin Pharm. 1974;8:650–655.
-        if sex == 'M':
-            return 50 + 0.91 * (height - 152.4)
-        elif sex == 'F':
-            return 45.5 + 0.91 * (height - 152.4)
+        return _by_sex(sex, 50 + 0.91 * (height - 152.4),
+                       45.5 + 0.91 * (height - 152.4))
     elif model == 'al-sallami':
         if age is None:
             raise ValueError
         bmi = weight / (height / 100) ** 2
-        if sex == 'M':
-            return (0.88 + ((1 - 0.88) / (1 + (age / 13.4) ** -12.7))) * 42.92 * weight / (30.93 + bmi)
-        elif sex == 'F':
-            return (1.11 + ((1 - 1.11) / (1 + (age / 7.1) ** -1.1))) * 37.99 * weight / (35.98 + bmi)
+        return _by_sex(sex, (0.88 + ((1 - 0.88) / (1 + (age / 13.4) ** -12.7))) * 42.92 * weight / (30.93 + bmi),
+                       (1.11 + ((1 - 1.11) / (1 + (age / 7.1) ** -1.1))) * 37.99 * weight / (35.98 + bmi))
     raise ValueError
 
+
+# registry of the models
+# each model is a covariate function of (age, sex, weight, height) which returns the parameters
+# made by _k() or _q(), so it works for both scalars and arrays of the demographics
+registry = {}
+
+def register(*names):
+    '''
+    decorator to register the covariate function of a model with its name and aliases
+    the function returns a dict of v1, k10, k12, k13, k21, k31, ke0 or v1, v2, v3, q1, q2, q3, ke0
+    (L, /min, L/min)
+    '''
+    def deco(func):
+        for name in names:
+            registry[name.lower()] = func
+        _params.cache_clear()
+        return func
+    return deco
+
+
+def _k(v1, k10=0, k12=0, k13=0, k21=0, k31=0, ke0=0):
+    return {'v1': v1, 'k10': k10, 'k12': k12, 'k13': k13, 'k21': k21, 'k31': k31, 'ke0': ke0}
+
+
+def _q(v1, v2=0, v3=0, q1=0, q2=0, q3=0, ke0=0):
+    return {'v1': v1, 'v2': v2, 'v3': v3, 'q1': q1, 'q2': q2, 'q3': q3, 'ke0': ke0}
+
+
+def _kparams(p):
+    '''
+    convert the parameters from a covariate function into (v1, k10, k12, k13, k21, k31, ke0) as setq() does
+    '''
+    if 'q1' not in p:
+        return tuple(p.get(key, 0) for key in ('v1', 'k10', 'k12', 'k13', 'k21', 'k31', 'ke0'))
+    v1, v2, v3, q1, q2, q3 = [p.get(key, 0) for key in ('v1', 'v2', 'v3', 'q1', 'q2', 'q3')]
+    if np.ndim(v2) == 0 and np.ndim(v3) == 0:
+        k21 = q2 / v2 if v2 != 0 else 0
+        k31 = q3 / v3 if v2 != 0 and v3 != 0 else 0
+    else:
+        k21 = np.where(v2 != 0, q2 / np.where(v2 != 0, v2, 1), 0)
+        k31 = np.where((v2 != 0) & (v3 != 0), q3 / np.where(v3 != 0, v3, 1), 0)
+    return v1, q1 / v1, q2 / v1, q3 / v1, k21, k31, p.get('ke0', 0)
+
+
+@functools.lru_cache(maxsize=4096)
+def _params(name, age, sex, weight, height):
+    '''
+    memoized parameters (v1, k10, k12, k13, k21, k31, ke0) of a model for a patient
+    '''
+    return tuple(float(x) for x in _kparams(registry[name](age, sex, weight, height)))
+
+
+def model_params(name, age=30, sex='F', weight=60, height=160):
+    '''
+    evaluate the covariate function of a model for the arrays of the demographics at once
+    returns: dict of arrays v1, k10, k12, k13, k21, k31, ke0 in the broadcast shape of the demographics
+    '''
+    name = name.lower()
+    if name not in registry:
+        raise ValueError('unsupported model')
+    age, sex, weight, height = np.broadcast_arrays(np.asarray(age), np.asarray(sex), np.asarray(weight), np.asarray(height))
+    p = _kparams(registry[name](age, sex, weight, height))
+    return {key: np.broadcast_to(np.asarray(x, dtype=float), age.shape) for key, x in zip(('v1', 'k10', 'k12', 'k13', 'k21', 'k31', 'ke0'), p)}
+
+
+@register('marsh')
+def _marsh(age, sex, weight, height):
+    # Marsh et al. Pharmacokinetic model driven infusion of propofol in children. Br J Anaesth 1991;67:41-8
+    return _k(0.228 * weight, 0.119, 0.114, 0.0419, 0.055, 0.0033, 0.26) # diprifusor
+
+
+@register('modified marsh')
+def _modified_marsh(age, sex, weight, height):
+    return _k(0.228 * weight, 0.119, 0.114, 0.0419, 0.055, 0.0033, 1.2195)  # stanpump, orchestra
+
+
+@register('schnider')
+def _schnider(age, sex, weight, height):
+    lbm = calc_lbm(sex, weight, height)
+    return _q(4.27, 18.9 - 0.391 * (age - 53), 238,
+        1.89 + 0.0456 * (weight - 77) - 0.0681 * (lbm - 59) + 0.0264 * (height - 177),
+        1.29 - 0.024 * (age - 53), 0.836, 
+        0.456)
+
+
+@register('paedfusor')
+def _paedfusor(age, sex, weight, height):
+    conds = [(1 <= age) & (age < 13), age <= 13, age <= 14, age <= 15, age <= 16]
+    if not np.any(conds, axis=0).all():
+        raise ValueError
+    v1 = np.select(conds, [0.4584 * weight, 0.4 * weight, 0.342 * weight, 0.284 * weight, 0.22857 * weight])
+    k10 = np.select(conds, [0.1527 * weight ** -0.3, 0.0678, 0.0792, 0.0954, 0.119])
+    ke0 = 0.26  # from diprifusor (for adults)
+    ke0 = 0.91  # Munoz et al Anesthesiology 2004:101(6)
+    return _k(v1, k10, 0.114, 0.0419, 0.055, 0.0033, ke0) 
+
+
+@register('kataria')
+def _kataria(age, sex, weight, height):
+    # Kataria et al. The pharmacokinetics of propofol in children using three different data analysis approaches. Anesthesiology 1994;80:104
+    return _q(0.41 * weight, 0.78 * weight + 3.1 * age - 15.5, 6.9 * weight,
+        0.035 * weight, 0.077 * weight, 0.026 * weight,
+        0.41) # Munoz et al Anesthesiology 2004:101(6)
+
+
+@register('choi')
+def _choi(age, sex, weight, height):  # propofol
+    # Choi et al. Population pharmacokinetic and pharmacodynamic model of propofol externally validated in children. J Pharmacokinet Pharmacodyn. 2015 Apr;42(2):163-77
+    return _q(1.69, 27.2 + 0.93 * (weight - 25), 0,
+        0.89 * (weight / 23.6) ** 0.97, 1.3, 0, 
+        0.371)
+
+
+# eleveld model
+_t1 = 6.28 # v1 ref
+_t2 = 25.5 # v2 ref
+_t3 = 273 # v3 ref
+_t4 = 1.79 # cl ref
+_t5 = 1.75 # q2 ref
+_t6 = 1.11 # q3 ref
+_t8 = 42.3 # cl maturation e50
+_t9 = 9.06 # cl maturation slope
+_t10 = -0.0156 # smaller v2 with age
+_t11 = -0.00286 # lower cl with age
+_t12 = 33.6 # v1 sigmoid e50=33.6 kg
+_t13 = -0.0138 # smaller v3 with age
+_t14 = 68.3 # maturation of q3
+_t15 = 2.1 # cl ref (female)
+_t16 = 1.3 # higher q2 for maturation of q3
+
+# reference patient
+_age_ref = 35
+_weight_ref = 70
+_ht_ref = 170
+_pma_ref = _age_ref * 52 + 40  # age(yrs) to pma(wks)
+_cl3_mat_ref = _sigmoid(_pma_ref, _t14, 1)
+_cl1_mat_ref = _sigmoid(_pma_ref, _t8, _t9)
+_v1_sig_ref = _sigmoid(_weight_ref, _t12, 1)
+_ffm_ref = calc_lbm('M', _weight_ref, _ht_ref, _age_ref, 'al-sallami')
+
+@register('eleveld')
+def _eleveld(age, sex, weight, height):
+    with_opioids = True
+
+    # age(yrs) to pma(wks)
+    pma = age * 52 + 40
+
+    cl3_mat = _sigmoid(pma, _t14, 1)
+
+    # lean body mass
+    ffm = calc_lbm(sex, weight, height, age, 'al-sallami')
+
+    v1 = _t1 * (_sigmoid(weight, _t12, 1) / _v1_sig_ref)
+    v2 = _t2 * (weight / _weight_ref) * np.exp(_t10 * (age - _age_ref))
+    v3 = _t3 * ffm / _ffm_ref
+    if with_opioids:
+        v3 *= np.exp(_t13 * age)
+    cl1 = np.where(np.asarray(sex) == 'M', _t4, _t15) * ((weight / _weight_ref) ** 0.75)
+    cl1 *= _sigmoid(pma, _t8, _t9) / _cl1_mat_ref  # age maturation
+    if with_opioids:
+        cl1 *= np.exp(_t11 * age)
+    cl2 = _t5 * (v2 / _t2) ** 0.75 * (1 + _t16 * (1 - cl3_mat))
+    cl3 = _t6 * (v3 / _t3) ** 0.75 * (cl3_mat / _cl3_mat_ref)
+    ke0 = 0.146 * ((weight / _weight_ref) ** -0.25)
+
+    return _q(v1, v2, v3, cl1, cl2, cl3, ke0)
+
+
+@register('minto')
+def _minto(age, sex, weight, height):
+    # Minto et al. Influence of age and gender on the pharmacokinetics and pharmacodynamicsof remifentanil. I. Model development. Anesthesiology, 86:10–23, 1997.
+    lbm = calc_lbm(sex, weight, height, 'james')
+    return _q(5.1 - 0.0201 * (age - 40) + 0.072 * (lbm - 55),
+        9.82 - 0.0811 * (age - 40) + 0.108 * (lbm - 55),
+        5.42,
+        2.6 - 0.0162 * (age - 40) + 0.0191 * (lbm - 55),
+        2.05 - 0.0301 * (age - 40),
+        0.076 - 0.00113 * (age - 40),
+        0.595 - 0.007 * (age - 40))
+
+
+@register('kim')
+def _kim(age, sex, weight, height):  # pk model of remifentanil
+    lbm = calc_lbm(sex, weight, height, 'janmahasatian')
+    return _q(4.76 * (weight / 74.5) ** 0.658,
+        8.4 * (lbm / 52.3) ** 0.573 - 0.0936 * (age-37),
+        4 - 0.0477 * (age-37),
+        2.77 * (weight / 74.5) ** 0.336 - 0.0149 * (age-37),
+        1.94 - 0.0280 * (age - 37),
+        0.197,
+        0.595 - 0.007 * (age - 40))  # minto's ke0
+
+
+@register('schuttler')
+def _schuttler(age, sex, weight, height): # remimazolam
+    # Schüttler et al. Pharmacokinetics and Pharmacodynamics of Remimazolam (CNS 7056) after Continuous Infusion in Healthy Male Volunteers: Part I. Pharmacokinetics and Clinical Pharmacodynamics. Anesthesiology. 2020 Apr;132(4):636-651.
+    return _q(4.7 * weight / 75, 14.5, 15.5, 
+        1.14, 1.04, 0.19, 
+        0.27)
+
+
+@register('schmith')
+def _schmith(age, sex, weight, height):
+    # Zhou et al. Population pharmacokinetic/pharmacodynamic modeling for remimazolam in the induction and maintenance of general anesthesia in healthy subjects and in surgical subjects. J Clin Anesth. 2020
+    v1 = 2.92 * weight / 70
+    v2 = 19.1 * weight / 70
+    # if asa3:
+    #     v1 *= 1 - 0.56
+    #     v2 *= 1.22
+    v3 = 9.81 * weight / 70
+    cl1 = 61.6 * weight / 70 * np.where(np.asarray(sex) == 'F', 1.11, 1) / 60
+    cl2 = 22.9 * weight / 70 / 60
+    cl3 = 69.6 * weight / 70 / 60
+    ke0 = 8.08 / 60
+    bmi = weight / (height / 100) ** 2
+    ke0 = np.where(bmi > 25, ke0 * 1.17, ke0)
+    # if asian: self.ke0 *= 1 - 0.48            
+    return _q(v1, v2, v3, cl1, cl2, cl3, ke0)
+
+
+@register('wierda')
+def _wierda(age, sex, weight, height):  # rocuronium
+    return _k(45 * weight / 1000, 0.1, 0.21, 0.028, 0.13, 0.01, 0.168)
+
+
+@register('cooper')
+def _cooper(age, sex, weight, height):  # rocuronium
+    return _k(38.5 * weight / 1000, 0.119, 0.259, 0.06, 0.163, 0.012, 0.168)
+
+
+@register('saldien')
+def _saldien(age, sex, weight, height):  # rocuronium
+    return _k(35.6 * weight / 1000, 0.126, 0.209, 0.05, 0.163, 0.015, 0.168)
+
+
+@register('dehaes', 'de haes')
+def _dehaes(age, sex, weight, height):  # rocuronium
+    return _k(42.0 * weight / 1000, 0.0762, 0.124, 0.0214, 0.13, 0.013, 0.15)
+
+
+@register('gepts')
+def _gepts(age, sex, weight, height): # sufentanil
+    # 10.1097/00000542-199512000-00010
+    #ke0 = recalc_ke0(5.6 * 60) # 0.176/min = 10.1097/00000542-199101000-00010 (Shafer/Varvel 1991)
+    # the ke0 value above is wrong based on the https://blog.tivatrainer.com/sufentanil-another-mistake-in-the-implementation-in-commercial-target-controlled-infusion-systems
+
+    #ke0 = 0.119  # this value is from the stanpump code, but it is not clear where it comes from
+    ke0 = 0.112  # Implementation of Gepts model in Fresenius Base Primea, Scott, Cooke, & Stanski, 1991, K for half life = 6.2 min
+    return _q(14.3, 63.1, 261.6, 0.92, 1.55, 0.33, ke0)
+
+
+@register('hannivoort')
+def _hannivoort(age, sex, weight, height): # dexemedetomidine
+    # 10.1097/ALN.0000000000000740
+    return _q(1.78 * (weight / 70), 30.3 * (weight / 70), 52.0 * (weight / 70),
+              0.686 * (weight / 70) ** 0.75, 2.98 * (weight / 70) ** 0.75, 0.602 * (weight / 70) ** 0.75,
+              0.120) # 10.1093/bja/aex085 (Colin et al. 2017)
+
+
+@register('scott')
+def _scott(age, sex, weight, height): # fentanyl 
+    # # k = 0.693 / hl
+    # # vd = cl * hl / 0.693
+    # hl2 = 1.0 # min
+    # hl3 = 18.5 # min
+    # q1 = 0.574 # L/min
+    # q2 = 4.005 # L/min
+    # q3 = 1.952 # L/min
+    # v1 = 12.7
+    # v2 = q2 * hl2 / 0.693 # = np.log(2)
+    # v3 = q3 * hl3 / 0.693 # = np.log(2)
+    # return _q(v1, v2, v3, q1, q2, q3) # 1987, J Pharmacol Exp Ther 1987 Jan;240(1):159-166
+    
+    # = _q(12.7, 49.34, 296.88, 0.71, 4.74, 2.29) # from pkpdtools.com
+    return _k(12.7, .056, .373, .180, .096, .0077, 0.693 / 4.7) # from stanpump code, 4.7 min half life of ke0
+
+# @register('shafer')
+# def _shafer(age, sex, weight, height): # fentanyl (unweighted)
+#     return _q(6.09, 28.1, 228, .504, 2.87, 1.37, ke0=_recalc_ke0(...)) # Anesthesiology. 1990;73:1091-102. 10.1097/00000542-199012000-00005
+#     # ke0 from tpeak 3.6 * 60, 10.1097/00000542-199101000-00010 (Shafer/Varvel 1991)
+# @register('mcclain', 'hug')
+# def _mcclain(age, sex, weight, height): # fentanyl
+#     return _k(0.356 * weight, 0.041, 0.185, 0.141, 0.103, 0.020, ke0=_recalc_ke0(...))  # ke0 from tpeak 3.6 * 60, 10.1097/00000542-199101000-00010 (Shafer/Varvel 1991)
+
+from .batch import ModelBatch
+from .parallel import run_many
+from .controller import TCIController
+from .replay import Replayer, replay
+from .storage import ResultWriter, read_results, _open_sink
+from .montecarlo import sample_iiv, montecarlo
+from .fit import predict, fit, fit_many, rate_changes
+from .interaction import run_drugs, greco, bouillon
+
 if __name__ == '__main__':
     print(Model('gepts'))
     # plt.figure(figsize=(20, 5))
@@ -1,65 +1,157 @@
-import sys
+'''
+batch simulation of the scenario files
+usage: python -m tivatci scenarios.jsonl [-o results] [--format npy] [--workers 4] [--profile]
+    scenarios.jsonl: one scenario per line as the dict of run_many, e.g.
+        {"name": "schnider", "age": 40, "sex": "M", "weight": 70, "height": 170, "cts": [[0, 3], [600, 2.5]], "maxrate": 10}
+    scenarios.csv: one target change per row with the columns case, name, age, sex, weight, height, time, target
+        and the optional columns method, maxrate, plasma, event, tmax, dt (taken from the first row of the case)
+        the consecutive rows of the same case are one scenario
+    the rows of Model.columns are written with the index of the scenario (Case) and the step (Time)
+    to stdout as csv or to the columnar directory of ResultWriter with -o, as soon as each scenario is finished
+'''
 import os
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
-import tivatci
-import matplotlib.pyplot as plt
-# plt.plot([lbm('M', x, 170, 'james') for x in range(30, 200)], label='james')
-# plt.plot([lbm('M', x, 170, 'janmahasatian') for x in range(30, 200)], label='janmahasatian')
-# plt.plot([lbm('M', x, 170, 'devine') for x in range(30, 200)], label='devine')
-# plt.legend()
-# plt.show()
-# exit(0)
-
-# model = Model('schnider', 80, 'M', 75, 172)
-# print(f'tpeak at {model.tpeak()} sec') # original tpeak
-
-# model.ke0 = model.recalculate_ke0(100)
-# print(model.ke0)
-# print(model.tpeak())
-# exit(0)
-
-# Compare models
-names = ['modified marsh', 'schnider', 'eleveld']#, 'ours']
-#names = ['minto', 'ours']
-#names = ['modified marsh']
-
-cts = [4] * 200 + [3] * 200 + [5] * 160 + [2] * 200 + [0] * 500
-#cts = [4] * 100 # + [3] * 200 + [5] * 160 + [2] * 200 + [0] * 500
-# names = ['schuttler', 'schmith']
-# cts = [1] * 200 + [1.5] * 200 + [1.2] * 160 + [1] * 200 + [0] * 500
-conc_unit = 'ug/ml'
-dose_unit = 'mg'
-styles = ['solid', 'dashed', 'dotted', 'dashdot']
-dfs = []
-for name in names:
-    if name == 'ours':
-        if 'schnider' in names:
-            model = tivatci.Model(v1=75 * 0.061, k10=0.668, k12=1.077, k13=0.416, k21=0.152, k31=0.025, ke0=0.326)
-        else:
-            model = tivatci.Model(v1=75 * 0.051, k10=0.259, k12=7.091, k13=0.029, k21=0.166, k31=0.154, ke0=0.995)
+import sys
+import csv
+import json
+import time
+import argparse
+import numpy as np
+from . import Model, ResultWriter
+from .parallel import iter_many
+
+stages = ('read', 'model', 'tci', 'propagation', 'io')
+numbers = ('age', 'weight', 'height', 'maxrate', 'tmax', 'dt')
+flags = ('plasma', 'event')
+
+
+def read_jsonl(f):
+    '''
+    returns: list of the scenarios of a json lines file
+    '''
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def read_csv(f):
+    '''
+    returns: list of the scenarios of a csv file with one target change per row
+    '''
+    scenarios = []
+    last = None
+    for row in csv.DictReader(f):
+        row = {key.strip(): val.strip() for key, val in row.items() if key and val is not None and val.strip()}
+        case = row.get('case')
+        if last is None or case != last:
+            last = case
+            scenario = {'name': row['name'], 'cts': []}
+            for key, val in row.items():
+                if key in numbers:
+                    scenario[key] = float(val)
+                elif key in flags:
+                    scenario[key] = val.lower() in ('1', 'true', 'yes')
+                elif key in ('sex', 'method'):
+                    scenario[key] = val
+            scenarios.append(scenario)
+        scenario['cts'].append((float(row['time']), float(row['target'])))
+    return scenarios
+
+
+def read_scenarios(path, format=None):
+    '''
+    path: scenario file or '-' for stdin
+    format: 'jsonl' or 'csv' (if None, by the extension of the path, jsonl for stdin)
+    '''
+    if format is None:
+        format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    if format not in ('jsonl', 'csv'):
+        raise ValueError('unsupported format')
+    read = read_csv if format == 'csv' else read_jsonl
+    if path == '-':
+        return read(sys.stdin)
+    with open(path, newline='' if format == 'csv' else None) as f:
+        return read(f)
+
+
+class CsvWriter:
+    '''
+    text sink with the interface of ResultWriter that writes the rows as csv
+    '''
+    def __init__(self, f, columns=Model.columns, index=('Case', 'Time')):
+        self.f = f
+        self.columns = tuple(columns)
+        self.index = tuple(index)
+        self.nrows = 0
+        f.write(','.join(self.index + self.columns) + '\n')
+
+    def write(self, data, **index):
+        n = len(data)
+        cols = [np.broadcast_to(index[name], (n,)) for name in self.index]
+        np.savetxt(self.f, np.column_stack(cols + [data]), fmt=['%d'] * len(cols) + ['%.9g'] * len(self.columns), delimiter=',')
+        self.nrows += n
+
+    def close(self):
+        self.f.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tivatci', description='batch TCI simulation of the scenario files')
+    parser.add_argument('scenarios', help="scenario file (.jsonl or .csv) or '-' for stdin")
+    parser.add_argument('-o', '--output', help='directory of the columnar results (default: csv to stdout)')
+    parser.add_argument('--input-format', choices=('jsonl', 'csv'), help='format of the scenario file (default: by the extension)')
+    parser.add_argument('--format', choices=('npy', 'parquet'), default='npy', help='columnar format of the output directory')
+    parser.add_argument('--dtype', choices=('float32', 'float64'), default='float32', help='type of the columnar values')
+    parser.add_argument('-j', '--workers', type=int, help='number of processes (default: the number of cpus, 1 to run in this process)')
+    parser.add_argument('--chunksize', type=int, default=1, help='number of scenarios sent to a worker at once')
+    parser.add_argument('--maxrate', type=float, help='maximum infusion rate of the scenarios without maxrate')
+    parser.add_argument('--dt', type=float, help='time step in seconds of the scenarios without dt')
+    parser.add_argument('--plasma', action='store_true', help='target the plasma concentration in the scenarios without plasma')
+    parser.add_argument('--profile', action='store_true', help='print the seconds of every stage to stderr')
+    args = parser.parse_args(argv)
+
+    timings = dict.fromkeys(stages, 0.0)
+    wall = time.perf_counter()
+    start = time.perf_counter()
+    scenarios = read_scenarios(args.scenarios, args.input_format)
+    for scenario in scenarios:
+        for key in ('maxrate', 'dt', 'plasma'):
+            if getattr(args, key) and key not in scenario:
+                scenario[key] = getattr(args, key)
+    timings['read'] = time.perf_counter() - start
+
+    if args.output:
+        writer = ResultWriter(args.output, Model.columns, dtype=args.dtype, format=args.format, index=('Case', 'Time'))
     else:
-        model = tivatci.Model(name, 40, 'M', 75, 172)
-    dfs.append(model.run(cts, plasma=True))
-
-fig, ax1 = plt.subplots(figsize=(20, 5))
-ax1.set_xlabel('time (s)')
-ax1.plot(dfs[0]['Ct'], color='blue', label='Ct')
-for i in range(len(names)):
-    ax1.plot(dfs[i]['Cp'], linestyle=styles[i], color='red', label=f'Cp ({names[i]})')
-    ax1.plot(dfs[i]['Ce'], linestyle=styles[i], color='green', label=f'Ce ({names[i]})')
-ax1.set_ylabel(f'Concentration ({conc_unit})')
-ax1.legend(loc='upper left')
-ax2 = ax1.twinx()
-for i in range(len(names)):
-    ax2.plot(dfs[i]['Infused'], linestyle=styles[i], color='gray', label=f'Infused ({names[i]})')
-ax2.set_ylabel(f'Infused ({dose_unit})')
-ax2.legend(loc='upper right')
-plt.show()
-quit()
-
-# infuse 80 mg propofol to a 70 kg patient
-model = tivatci.Model('modified marsh', weight=70)
-print(f'max ce={max(model.ce(dose=80)):.2f}')
-quit()
+        writer = CsvWriter(sys.stdout)
+    nrows = 0
+    try:
+        for i, (res, stage) in iter_many(scenarios, args.workers, args.chunksize, profile=True):
+            for key, sec in zip(('model', 'tci', 'propagation'), stage):
+                timings[key] += sec
+            start = time.perf_counter()
+            writer.write(res, Case=i, Time=np.arange(len(res)))
+            timings['io'] += time.perf_counter() - start
+            nrows += len(res)
+        start = time.perf_counter()
+        writer.close()
+        timings['io'] += time.perf_counter() - start
+    except BrokenPipeError:  # the reader of stdout is closed (e.g. head)
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        if args.output:
+            writer.close()
+    wall = time.perf_counter() - wall
+
+    if args.profile:
+        n = max(len(scenarios), 1)
+        err = sys.stderr
+        print(f'{len(scenarios)} scenarios, {nrows} rows', file=err)
+        print(f"{'stage':12s} {'seconds':>10s} {'ms/scenario':>12s}", file=err)
+        for key in stages:
+            print(f'{key:12s} {timings[key]:10.3f} {timings[key] / n * 1000:12.3f}', file=err)
+        print(f"{'wall':12s} {wall:10.3f} {wall / n * 1000:12.3f}", file=err)
+        if args.workers != 1 and len(scenarios) > 1:
+            print('model, tci and propagation are summed over the workers', file=err)
+
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+import numpy as np
+from . import Model, _tpeak, _recalc_ke0, model_params, _eig, _discretize, _exp_sum, _decrement_time
+from .storage import _open_sink
+
+
+class ModelBatch:
+    '''
+    population of models that are simulated together
+    the parameters are stored as arrays in the shape (N,) and the compartment states in the shape (N, 4)
+    '''
+    columns = ('Cp', 'Ce', 'Rate', 'Infused')
+    v1_v4 = Model.v1_v4
+
+    def __init__(self, name=None, age=30, sex='F', weight=60, height=160, models=None, method='euler'):
+        '''
+        build the models of a population from the name of the model and the arrays of the demographics
+        age, sex, weight, height: scalars or arrays which are broadcast to the same shape
+        models: list of Model to use instead of the name and the demographics
+        method: 'euler' or 'exact' (see Model)
+        '''
+        self.method = method
+        if models is None:  # vectorized covariate function of the model
+            for key, x in model_params(name, age, sex, weight, height).items():
+                setattr(self, key, np.ravel(x).astype(float))
+        else:
+            for key in ('v1', 'k10', 'k12', 'k13', 'k21', 'k31', 'ke0'):
+                setattr(self, key, np.array([getattr(m, key) for m in models], dtype=float))
+        self._cache = {}
+
+    @classmethod
+    def from_models(cls, models, method=None):
+        '''
+        build a batch from the list of Model
+        '''
+        if method is None:
+            method = models[0].method if models else 'euler'
+        return cls(models=models, method=method)
+
+    @classmethod
+    def from_params(cls, v1, k10, k12, k13, k21, k31, ke0, method='euler'):
+        '''
+        build a batch from the arrays of the parameters in the shape (N,)
+        '''
+        self = cls.__new__(cls)
+        self.method = method
+        for key, x in zip(('v1', 'k10', 'k12', 'k13', 'k21', 'k31', 'ke0'), np.broadcast_arrays(v1, k10, k12, k13, k21, k31, ke0)):
+            setattr(self, key, np.ravel(x).astype(float))
+        self._cache = {}
+        return self
+
+    def __len__(self):
+        return len(self.v1)
+
+    def __getitem__(self, i):
+        '''
+        returns the Model of the i-th patient
+        '''
+        return Model(method=self.method, v1=self.v1[i], k10=self.k10[i], k12=self.k12[i], k13=self.k13[i], k21=self.k21[i], k31=self.k31[i], ke0=self.ke0[i])
+
+    def tpeak(self, ke0=None):
+        '''
+        analytical time to the peak effect site concentration after a bolus of every patient (see Model.tpeak)
+        ke0: the elimination rates from the effect site (if None, use the self.ke0)
+        returns: array of the times in seconds
+        '''
+        if ke0 is None:
+            ke0 = self.ke0
+        return _tpeak(self.k10, self.k12, self.k13, self.k21, self.k31, ke0)
+
+    def recalc_ke0(self, tpeak):
+        '''
+        ke0 of every patient that gives the time to peak effect (see Model.recalc_ke0)
+        tpeak: the times to peak effect in seconds, scalar or array in the shape (N,)
+        returns: array of ke0 in /min
+        '''
+        return _recalc_ke0(self.k10, self.k12, self.k13, self.k21, self.k31, tpeak)
+
+    def _rate_eig(self, dt=1):
+        '''
+        eigendecomposition of the rate matrices of every patient in step^-1 (see tivatci._eig)
+        returns: (lam, v, vinv) in the shape (N, 4), (N, 4, 4), (N, 4, 4)
+        '''
+        key = ('eig', dt)
+        if key not in self._cache:
+            self._cache[key] = _eig(self.k10, self.k12, self.k13, self.k21, self.k31, self.ke0, self.v1_v4, dt)
+        return self._cache[key]
+
+    def _modes(self, dt=1):
+        '''
+        vectorized tivatci._modes of every patient for one step of dt seconds
+        returns: (mu, h, v, vinv) in the shape (N, 4), (N, 4), (N, 4, 4), (N, 4, 4)
+        '''
+        lam, v, vinv = self._rate_eig(dt)
+        mu, h = _discretize(lam, vinv, self.method, dt)
+        return mu, h, v, vinv
+
+    def _decay_coef(self, a, plasma):
+        '''
+        exponents and coefficients of the concentrations of every patient without infusion (see Model._decay_coef)
+        returns: (lam, coef) in the shape (N, 4)
+        '''
+        lam, v, vinv = self._rate_eig()
+        out = v[:, 0, :] / self.v1[:, None] if plasma else v[:, 3, :] / self.v1[:, None] * self.v1_v4
+        return lam, out * np.einsum('nij,nj->ni', vinv, np.asarray(a, dtype=float))
+
+    def forecast(self, t, a, plasma=False):
+        '''
+        analytical concentrations of every patient after t seconds if the infusion is stopped (see Model.forecast)
+        t: seconds from now, scalar or array broadcastable to (N,) such as (K, N) or (K, 1) for K horizons
+        a: the current states of the compartments in the shape (N, 4)
+        '''
+        lam, coef = self._decay_coef(a, plasma)
+        return _exp_sum(lam, coef, t)
+
+    def decrement_time(self, c, a, plasma=False):
+        '''
+        analytical time in seconds until the concentration of every patient falls to c if the infusion is stopped (see Model.decrement_time)
+        c: the concentrations, scalar or array broadcastable to (N,) such as (K, N) or (K, 1) for K thresholds
+        a: the current states of the compartments in the shape (N, 4)
+        '''
+        lam, coef = self._decay_coef(a, plasma)
+        return _decrement_time(lam, coef, c)
+
+    def _update(self):
+        '''
+        update matrices of every patient for one second
+        a(t+1) = mat @ a(t) + vec * dose
+        returns: (mat, vec) in the shape (N, 4, 4) and (N, 4)
+        '''
+        if 'update' not in self._cache:
+            n = len(self)
+            if self.method == 'exact':
+                mu, h, v, vinv = self._modes()
+                mat = ((v * mu[:, None, :]) @ vinv).real
+                vec = np.einsum('nij,nj->ni', v, h).real
+            elif self.method == 'euler':
+                z = np.zeros(n)
+                mat = np.stack([
+                    np.stack([1 - (self.k10 + self.k12 + self.k13) / 60, self.k21 / 60, self.k31 / 60, z], axis=-1),
+                    np.stack([self.k12 / 60, 1 - self.k21 / 60, z, z], axis=-1),
+                    np.stack([self.k13 / 60, z, 1 - self.k31 / 60, z], axis=-1),
+                    np.stack([self.ke0 / self.v1_v4 / 60, z, z, 1 - self.ke0 / 60], axis=-1),
+                ], axis=1)
+                vec = np.zeros((n, 4))
+                vec[:, 0] = 1
+            else:
+                raise ValueError('unsupported method')
+            self._cache['update'] = (mat, vec)
+        return self._cache['update']
+
+    def udf(self, plasma=False):
+        '''
+        unit disposition functions of every patient (see Model.udf)
+        returns: (udf, lengths) where udf is in the shape (N, max(lengths)) and padded with zeros
+        '''
+        key = ('udf', plasma)
+        if key not in self._cache:
+            mat, vec = self._update()
+            n = len(self)
+            a = np.zeros((n, 4))
+            if plasma:
+                ret = np.empty((n, 10))
+                for i in range(10):
+                    a = np.matmul(mat, a[..., None])[..., 0] + vec
+                    ret[:, i] = a[:, 0] / self.v1
+                lens = np.full(n, 10)
+            else:  # until the peak of the effect site concentration of every patient
+                rows = []
+                lens = np.zeros(n, dtype=int)
+                last_a4 = np.zeros(n)
+                for i in range(9999):
+                    a = np.matmul(mat, a[..., None])[..., 0]
+                    if i < 10:
+                        a += vec
+                    peaked = (lens == 0) & (a[:, 3] < last_a4)
+                    lens[peaked] = i
+                    if (lens > 0).all():
+                        break
+                    last_a4 = a[:, 3]
+                    rows.append(a[:, 3] / self.v1 * self.v1_v4)
+                lens[lens == 0] = len(rows)
+                ret = np.stack(rows, axis=1)
+                ret[np.arange(ret.shape[1]) >= lens[:, None]] = 0
+            self._cache[key] = (ret, lens)
+        return self._cache[key]
+
+    def decay(self, plasma=False):
+        '''
+        free decay responses of every patient (see Model.decay)
+        returns: array in the shape (N, max(lengths), 4)
+        '''
+        key = ('decay', plasma)
+        if key not in self._cache:
+            mat, vec = self._update()
+            udf, lens = self.udf(plasma)
+            a = np.broadcast_to(np.eye(4), mat.shape)
+            ret = np.empty((len(self), udf.shape[1], 4))
+            for i in range(udf.shape[1]):
+                a = np.matmul(mat, a)
+                ret[:, i, :] = a[:, 0, :] / self.v1[:, None] if plasma else a[:, 3, :] / self.v1[:, None] * self.v1_v4
+            self._cache[key] = ret
+        return self._cache[key]
+
+    tol = Model.tol
+    maxiter = Model.maxiter
+    def tci(self, ct, a=None, plasma=False, idx=None, tol=None, maxiter=None):
+        '''
+        vectorized Model.tci for the patients in idx
+        ct: target concentration
+        a: the states of the compartments in the shape (len(idx), 4)
+        idx: indices of the patients (if None, every patient)
+        tol, maxiter: see Model.tci (if None, use the self.tol and self.maxiter)
+        returns: (rate, tpeak) in the shape (len(idx),)
+        '''
+        if idx is None:
+            idx = np.arange(len(self))
+        if a is None:
+            a = np.zeros((len(idx), 4))
+        if tol is None:
+            tol = self.tol
+        if maxiter is None:
+            maxiter = self.maxiter
+        udf, lens = self.udf(plasma)
+        udf = udf[idx]
+        b = np.matmul(self.decay(plasma)[idx], a[:, :, None])[:, :, 0]  # natural decay
+        cols = np.arange(udf.shape[1])
+
+        tpeak = lens[idx] - 1  # initial tpeak
+        rate = np.zeros(len(idx))
+
+        # if the current concentration is higher than the target, wait until it is lower than the target
+        over = np.flatnonzero(b[:, 0] > ct)
+        below = b[over] < ct
+        wait = below[np.arange(len(over)), tpeak[over]]
+        tpeak[over[wait]] = np.argmax(below[wait], axis=1)
+
+        active = np.flatnonzero(b[:, 0] <= ct)
+        b = b[active]
+        udf = udf[active]
+        tpeak_active = tpeak[active]
+        for _ in range(maxiter if tol else 0):
+            if not len(active):
+                break
+            w = tpeak_active.max() + 1  # tpeak only decreases
+            rows = np.arange(len(active))
+            r = (ct - b[rows, tpeak_active]) / udf[rows, tpeak_active]
+            c = np.where(cols[:w] <= tpeak_active[:, None], b[:, :w] + udf[:, :w] * r[:, None], -np.inf)
+            new_tpeak = np.argmax(c, axis=1)
+            done = (new_tpeak == tpeak_active) | (np.abs(c[rows, new_tpeak] - ct) <= ct * tol)
+            rate[active] = r
+            tpeak[active] = tpeak_active
+            keep = ~done
+            active = active[keep]
+            b = b[keep]
+            udf = udf[keep]
+            tpeak_active = new_tpeak[keep]
+
+        if len(active):  # direct solution (see tivatci._tci)
+            valid = udf > 0
+            rates = np.full(udf.shape, np.inf)
+            rates[valid] = (ct - b[valid]) / udf[valid]
+            tpeak[active] = np.argmin(rates, axis=1)
+            rate[active] = rates[np.arange(len(active)), tpeak[active]]
+        return rate, tpeak
+
+    def run(self, cts, maxrate=None, plasma=False, dtype=np.float64, sink=None, chunk=3600):
+        '''
+        run the TCI simulation of Model.run for every patient with the same target concentrations
+        cts: target concentration at every second
+        sink: ResultWriter with the index ('Case', 'Time') or its directory
+            the results are written every chunk seconds instead of being kept in memory
+        returns: array in the shape (N, len(cts), 4) of the columns Cp, Ce, Rate, Infused (None with the sink)
+        '''
+        mat, vec = self._update()
+        mat = np.ascontiguousarray(mat.transpose(1, 2, 0))  # (4, 4, N) for the update of the states in the shape (4, N)
+        vec = np.ascontiguousarray(vec.T)
+        n = len(self)
+        writer = None
+        if sink is not None:
+            writer, owned = _open_sink(sink, self.columns, ('Case', 'Time'))
+            ret = np.empty((min(chunk, len(cts)), 4, n), dtype=dtype)
+        else:
+            ret = np.empty((len(cts), 4, n), dtype=dtype)
+        a = np.zeros((4, n))  # initial state
+        rate = np.zeros(n)
+        infused = np.zeros(n)
+        wait_until = np.zeros(n, dtype=int)
+        infuse_until = np.zeros(n, dtype=int)
+        last_ct = 0
+        for i in range(len(cts)):
+            ct = cts[i]
+            if ct != last_ct:
+                last_ct = ct
+                idx = np.arange(n)
+            else:
+                idx = np.flatnonzero(i >= wait_until)
+            if len(idx):
+                r, tpeak = self.tci(ct, a[:, idx].T, plasma=plasma, idx=idx)
+                infuse_until[idx] = i + 10
+                if maxrate:
+                    limited = r > maxrate
+                    r[limited] = maxrate
+                    wait_until[idx] = np.where(limited, i + 10, i + tpeak + 1)
+                else:
+                    wait_until[idx] = i + tpeak + 1
+                rate[idx] = r
+            rate[i >= infuse_until] = 0
+            a = np.einsum('ijn,jn->in', mat, a) + vec * rate
+            j = i % len(ret)
+            ret[j, 0] = a[0] / self.v1
+            ret[j, 1] = a[3] / self.v1 * self.v1_v4
+            ret[j, 2] = rate
+            infused += rate
+            ret[j, 3] = infused
+            if writer is not None and (j == len(ret) - 1 or i == len(cts) - 1):  # write the chunk of every patient
+                block = ret[:j + 1].transpose(2, 0, 1)
+                writer.write(block.reshape(-1, 4), Case=np.repeat(np.arange(n), j + 1), Time=np.tile(np.arange(i - j, i + 1), n))
+        if writer is not None:
+            if owned:
+                writer.close()
+            return None
+        return ret.transpose(2, 0, 1)
+
+    def __repr__(self):
+        return f'ModelBatch(n={len(self)}, method={self.method!r})'
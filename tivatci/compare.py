@@ -0,0 +1,37 @@
+'''
+comparison plot of the models for the same targets
+usage: python -m tivatci.compare
+'''
+from . import Model
+
+styles = ['solid', 'dashed', 'dotted', 'dashdot']
+
+
+def compare(names, cts, conc_unit='ug/ml', dose_unit='mg'):
+    '''
+    plot Cp, Ce and the infused amount of the models (age 40, male, 75 kg, 172 cm) for the plasma targets
+    names: names of the models (up to 4)
+    cts: target concentration at every second
+    '''
+    import matplotlib.pyplot as plt
+
+    dfs = [Model(name, 40, 'M', 75, 172).run(cts, plasma=True) for name in names]
+
+    fig, ax1 = plt.subplots(figsize=(20, 5))
+    ax1.set_xlabel('time (s)')
+    ax1.plot(dfs[0]['Ct'], color='blue', label='Ct')
+    for i in range(len(names)):
+        ax1.plot(dfs[i]['Cp'], linestyle=styles[i], color='red', label=f'Cp ({names[i]})')
+        ax1.plot(dfs[i]['Ce'], linestyle=styles[i], color='green', label=f'Ce ({names[i]})')
+    ax1.set_ylabel(f'Concentration ({conc_unit})')
+    ax1.legend(loc='upper left')
+    ax2 = ax1.twinx()
+    for i in range(len(names)):
+        ax2.plot(dfs[i]['Infused'], linestyle=styles[i], color='gray', label=f'Infused ({names[i]})')
+    ax2.set_ylabel(f'Infused ({dose_unit})')
+    ax2.legend(loc='upper right')
+    plt.show()
+
+
+if __name__ == '__main__':
+    compare(['modified marsh', 'schnider', 'eleveld'], [4] * 200 + [3] * 200 + [5] * 160 + [2] * 200 + [0] * 500)
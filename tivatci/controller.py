@@ -0,0 +1,137 @@
+import numpy as np
+from . import _modes, _segment, _decide, _decision_state
+
+
+class TCIController:
+    '''
+    stateful TCI controller that receives the target concentrations one at a time
+    it makes the same rate decisions as Model.run but keeps only the current state,
+    so the memory does not grow with the duration of the case
+    '''
+    def __init__(self, model, maxrate=None, plasma=False):
+        '''
+        model: Model to control
+        maxrate: maximum infusion rate
+        plasma: if True, target the plasma concentration
+        '''
+        self.model = model
+        self.maxrate = maxrate
+        self.plasma = plasma
+        m = model
+        self._mu, self._h, v, vinv = _modes(m.k10, m.k12, m.k13, m.k21, m.k31, m.ke0, m.v1_v4, m.method)
+        self._v = v
+        self._out = v[[0, 3]].T / m.v1 * np.array([1, m.v1_v4])  # modal state to Cp and Ce
+        self.reset()
+
+    def reset(self):
+        '''
+        start a new case with empty compartments
+        '''
+        self.t = 0  # elapsed seconds
+        self.ct = 0  # current target
+        self.infused = 0
+        self._z = np.zeros(4, dtype=self._mu.dtype)  # modal state of the compartments
+        self._conc = np.zeros(2)  # Cp and Ce of the last second
+        self._state = _decision_state()  # rate decision of _decide
+
+    @property
+    def rate(self):
+        '''
+        infusion rate of the last second
+        '''
+        return self._state['rate']
+
+    @property
+    def a(self):
+        '''
+        amounts in the compartments
+        '''
+        return (self._v @ self._z).real
+
+    @property
+    def cp(self):
+        return self._conc[0]
+
+    @property
+    def ce(self):
+        return self._conc[1]
+
+    @property
+    def record(self):
+        '''
+        (t, Cp, Ce, rate) of the last second
+        '''
+        cp, ce = self._conc
+        return self.t, cp, ce, self.rate
+
+    def _decide(self):
+        '''
+        decide the rate of the current second as in Model.run
+        returns: the seconds until the next decision with the current target
+        '''
+        return _decide(self.model, self.t, self.ct, self._state, lambda: self.a, self.maxrate, self.plasma, dt=1)
+
+    def _propagate(self, n):
+        '''
+        propagate the compartments for n seconds with the current rate
+        '''
+        self._z, conc = _segment(self._z, self.rate, n, self._mu, self._h, self._out, self.model.method == 'euler')
+        self._conc = conc[-1]
+        self.t += n
+        self.infused += self.rate * n
+
+    def step(self, target=None):
+        '''
+        advance one second
+        target: new target concentration (if None, keep the current target)
+        returns: the infusion rate of this second
+        '''
+        if target is not None:
+            self.ct = target
+        self._decide()
+        self._propagate(1)
+        return self.rate
+
+    def advance(self, seconds, target=None):
+        '''
+        advance the given seconds with the same target
+        the rate is decided only at the events and the compartments are propagated in closed form between them
+        returns: the record of the last second
+        '''
+        if target is not None:
+            self.ct = target
+        end = self.t + seconds
+        while self.t < end:
+            n = self._decide()
+            self._propagate(min(n, end - self.t))
+        return self.record
+
+    def records(self, targets):
+        '''
+        generator of the records of every second for the iterable of the target concentrations
+        targets: target concentration at every second (None to keep the current target)
+        yields: (t, Cp, Ce, rate)
+        '''
+        for target in targets:
+            self.step(target)
+            yield self.record
+
+    def snapshot(self):
+        '''
+        returns: the state of the controller which can be given to restore()
+        '''
+        return {'t': self.t, 'ct': self.ct, 'infused': self.infused, 'z': self._z.copy(), **self._state}
+
+    def restore(self, state):
+        '''
+        restore the state from snapshot()
+        '''
+        self.t = state['t']
+        self.ct = state['ct']
+        self.infused = state['infused']
+        self._z = np.array(state['z'], dtype=self._mu.dtype)
+        self._conc = np.maximum((self._z @ self._out).real, 0)
+        self._state = {key: state[key] for key in _decision_state()}
+
+    def __repr__(self):
+        return f'TCIController(t={self.t}, ct={self.ct}, rate={self.rate:.4f})'
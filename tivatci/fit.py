@@ -0,0 +1,183 @@
+import os
+import copy
+import concurrent.futures
+import numpy as np
+
+names = ('v1', 'k10', 'k12', 'k13', 'k21', 'k31', 'ke0')
+
+
+def rate_changes(doses):
+    '''
+    convert the infusion rates at every second (as the dose of Model.sim) into the rate changes
+    returns: (times, rates) where the rate is rates[i] from times[i] seconds
+    '''
+    doses = np.asarray(doses, dtype=float)
+    times = np.r_[0, np.flatnonzero(np.diff(doses)) + 1] if len(doses) else np.zeros(0, dtype=int)
+    return np.r_[times, len(doses)], np.r_[doses[times], 0]
+
+
+def _system(model, effect):
+    '''
+    rate matrix in sec^-1 of the compartments and its derivatives by the log of the rate constants
+    returns: (k, dks, free names of the rate constants)
+    '''
+    m = 4 if effect else 3
+    k = np.zeros((m, m))
+    dks = []
+
+    def add(i, j, rate):  # rate from compartment j to compartment i (None for the elimination)
+        d = np.zeros((m, m))
+        d[j, j] -= rate
+        if i is not None:
+            d[i, j] += rate
+        return d
+
+    d = {
+        'k10': add(None, 0, model.k10),
+        'k12': add(1, 0, model.k12),
+        'k13': add(2, 0, model.k13),
+        'k21': add(0, 1, model.k21),
+        'k31': add(0, 2, model.k31),
+    }
+    if effect:  # the amount of the effect site is negligible (v1_v4) and it does not return to the central compartment
+        d0 = np.zeros((m, m))
+        d0[3, 0] = model.ke0 / model.v1_v4
+        d0[3, 3] = -model.ke0
+        d['ke0'] = d0
+    for key, dk in d.items():
+        k += dk
+    return k / 60, [dk / 60 for dk in d.values()], list(d)
+
+
+def predict(model, sample_times, times, rates, effect=False, jac=False):
+    '''
+    concentrations at the sample times with the analytical solution of the compartments
+    the infusion rate is constant between the changes and the state is propagated only between the changes and the samples
+    with the matrix exponential of the system augmented with the sensitivities to the parameters
+    model: Model with the parameters
+    sample_times: times of the samples in seconds
+    times, rates: the infusion rate (amount per second) is rates[i] from times[i] seconds (see rate_changes)
+    effect: if True, predict the effect site concentrations instead of the plasma concentrations
+    jac: if True, also return the derivatives by the log of the parameters
+    returns: concentrations in the shape (len(sample_times),)
+        and with jac, (concentrations, jacobian in the shape (len(sample_times), number of parameters), names of the parameters)
+        where the parameters are v1, k10, k12, k13, k21, k31 and ke0 (only with effect)
+    '''
+    from scipy.linalg import expm
+
+    sample_times = np.asarray(sample_times, dtype=float)
+    times = np.asarray(times, dtype=float)
+    rates = np.asarray(rates, dtype=float)
+    k, dks, keys = _system(model, effect)
+    m = len(k)
+    if not jac:
+        dks = []
+    p = len(dks)
+
+    # augmented state [a, da/dlog(k_1), ..., da/dlog(k_p), rate]
+    size = m * (p + 1) + 1
+    aug = np.zeros((size, size))
+    for j in range(p + 1):
+        aug[j * m:(j + 1) * m, j * m:(j + 1) * m] = k
+        if j:
+            aug[j * m:(j + 1) * m, :m] = dks[j - 1]
+    aug[0, -1] = 1  # infusion into the central compartment
+
+    start = min(times[0], sample_times.min()) if len(times) else 0
+    pts = np.union1d(np.r_[start, times], sample_times)
+    taus = np.diff(pts)
+    utaus, inv = np.unique(taus, return_inverse=True)
+    exps = expm(aug[None] * utaus[:, None, None])  # the segments of the same length share the matrix exponential
+
+    idx = np.searchsorted(times, pts[:-1], side='right') - 1
+    seg_rates = np.where(idx >= 0, rates[np.maximum(idx, 0)], 0)
+    states = np.empty((len(pts), size))
+    x = np.zeros(size)
+    states[0] = x
+    for i in range(len(taus)):
+        x[-1] = seg_rates[i]
+        x = exps[inv[i]] @ x
+        states[i + 1] = x
+    states = states[np.searchsorted(pts, sample_times)]
+
+    row = 3 if effect else 0
+    scale = (model.v1_v4 if effect else 1) / model.v1
+    conc = states[:, row] * scale
+    if not jac:
+        return conc
+    jacobian = np.empty((len(sample_times), p + 1))
+    jacobian[:, 0] = -conc  # the amounts do not depend on v1
+    for j in range(p):
+        jacobian[:, j + 1] = states[:, (j + 1) * m + row] * scale
+    return conc, jacobian, ['v1'] + keys
+
+
+def fit(sample_times, observed, times, rates, init, effect=False, fixed=(), error='proportional', full_output=False, **kwds):
+    '''
+    fit the parameters to the observed concentrations with scipy.optimize.least_squares and the analytic jacobian
+    the parameters are fitted on the log scale so that they stay positive
+    sample_times, times, rates, effect: see predict
+    observed: observed concentrations at the sample times
+    init: Model with the initial parameters (the parameters that are not fitted are kept)
+    fixed: names of the parameters that are not fitted (ke0 is not fitted without effect)
+    error: 'proportional' or 'additive' residual error
+    kwds: given to scipy.optimize.least_squares
+    returns: Model with the fitted parameters (and the result of least_squares with full_output)
+    '''
+    from scipy.optimize import least_squares
+
+    if error not in ('proportional', 'additive'):
+        raise ValueError('unsupported error')
+    observed = np.asarray(observed, dtype=float)
+    weight = 1 / observed if error == 'proportional' else np.ones_like(observed)
+    params = {key: getattr(init, key) for key in names}
+    keys = ['v1'] + _system(init, effect)[2]
+    free = [key for key in keys if key not in fixed and params[key] > 0]
+    cols = [keys.index(key) for key in free]
+    model = copy.copy(init)
+
+    def update(x):
+        for key, val in zip(free, np.exp(x)):
+            setattr(model, key, val)
+
+    def residuals(x):
+        update(x)
+        return (predict(model, sample_times, times, rates, effect) - observed) * weight
+
+    def jacobian(x):
+        update(x)
+        _, jac, _ = predict(model, sample_times, times, rates, effect, jac=True)
+        return jac[:, cols] * weight[:, None]
+
+    res = least_squares(residuals, np.log([params[key] for key in free]), jac=jacobian, **kwds)
+    update(res.x)
+    model.setk(model.v1, model.k10, model.k12, model.k13, model.k21, model.k31, model.ke0)  # reset the cache
+    if full_output:
+        return model, res
+    return model
+
+
+def _fit_one(args):
+    subject, kwds = args
+    kwds = dict(kwds, **{key: val for key, val in subject.items() if key in ('init', 'effect', 'fixed', 'error')})
+    return fit(subject['sample_times'], subject['observed'], subject['times'], subject['rates'], **kwds)
+
+
+def fit_many(subjects, init=None, workers=None, chunksize=1, **kwds):
+    '''
+    fit many subjects over a process pool
+    subjects: list of dict with 'sample_times', 'observed', 'times', 'rates' and optionally 'init', 'effect', 'fixed', 'error' (see fit)
+    init: initial Model of the subjects without 'init'
+    workers: number of processes (if None, os.cpu_count(); if 1, fit in this process)
+    kwds: given to fit
+    returns: list of the fitted Model in the order of the subjects
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if init is not None:
+        kwds['init'] = init
+    args = [(subject, kwds) for subject in subjects]
+    if workers == 1:
+        return [_fit_one(arg) for arg in args]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_fit_one, args, chunksize=chunksize))
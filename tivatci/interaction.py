@@ -0,0 +1,135 @@
+import numpy as np
+from . import Model, _modes, _segment, _changepoints, _decide, _decision_state
+
+
+def greco(ca, cb, c50a, c50b, gamma, alpha):
+    '''
+    Greco response surface of two drugs with a common steepness
+    1 = ua / x + ub / x + alpha * ua * ub / x ** 2 where ua = ca / c50a, ub = cb / c50b and x = (e / (1 - e)) ** (1 / gamma)
+    is solved in closed form for the effect e (alpha > 0 for synergy, -1 <= alpha < 0 for antagonism)
+    ca, cb: concentrations of the drugs, scalars or arrays in the same shape (negative values are taken as 0)
+    c50a, c50b: concentrations of each drug alone for the half of the maximum effect
+    gamma: steepness of the surface
+    alpha: interaction parameter
+    returns: the effect in [0, 1] (e.g. the probability of no response)
+    '''
+    ua = np.maximum(np.asarray(ca, dtype=float), 0) / c50a
+    ub = np.maximum(np.asarray(cb, dtype=float), 0) / c50b
+    u = ua + ub
+    x = (u + np.sqrt(np.maximum(u ** 2 + 4 * alpha * ua * ub, 0))) / 2
+    xg = x ** gamma
+    return xg / (1 + xg)
+
+
+def bouillon(cp, cr, c50p, c50r, gammap, gammar):
+    '''
+    hierarchical response surface of Bouillon et al. (2004) for a hypnotic and an opioid
+    the opioid decreases the c50 of the hypnotic by its own sigmoid, c50p * (1 - cr ** gammar / (cr ** gammar + c50r ** gammar))
+    cp, cr: concentrations of the hypnotic and the opioid, scalars or arrays in the same shape (negative values are taken as 0)
+    c50p, gammap: c50 and steepness of the hypnotic without the opioid
+    c50r, gammar: c50 and steepness of the opioid for the decrease of c50p
+    returns: the effect in [0, 1] (e.g. the probability of no response)
+    '''
+    cp = np.maximum(np.asarray(cp, dtype=float), 0)
+    cr = np.maximum(np.asarray(cr, dtype=float), 0)
+    c50 = c50p * (1 - cr ** gammar / (cr ** gammar + c50r ** gammar))
+    with np.errstate(divide='ignore'):
+        x = (cp / c50) ** gammap
+    return np.where(np.isinf(x), 1, x / (1 + x))
+
+
+def _per_drug(value, n):
+    '''
+    broadcast a scalar option to every drug
+    '''
+    if np.ndim(value) == 0:
+        return [value] * n
+    if len(value) != n:
+        raise ValueError(f'an option for each of the {n} drugs is required')
+    return list(value)
+
+
+def run_drugs(models, cts, maxrate=None, plasma=False, tmax=None, surface=None, dt=None):
+    '''
+    concurrent TCI simulation of several drugs on a shared timeline
+    every drug makes the same rate decisions as Model.run with its own targets,
+    and all compartments are propagated together between the events with the block-diagonal (modal) update
+    models: list of Model (one per drug)
+    cts: list of the targets of every drug, each the target concentration at every step or the list of (time in seconds, target concentration)
+        the targets after the end of a shorter list of the steps are 0
+    maxrate, plasma: see Model.run, scalars for every drug or lists with one value per drug
+    tmax: duration in seconds for the lists of target changes (if None, the longest duration of the drugs)
+    surface: function of the effect site concentrations of the drugs (as positional arguments in the order of models)
+        such as lambda ce1, ce2: greco(ce1, ce2, ...), evaluated on the arrays of every propagated segment
+    dt: time step in seconds (if None, use the dt of the first model)
+    returns: array in the shape (number of steps, len(models), 5) of the columns Model.columns
+        and with surface, (array, the response at every step)
+    '''
+    if isinstance(models, Model):
+        models = [models]
+    nd = len(models)
+    if len(cts) != nd:
+        raise ValueError(f'targets for each of the {nd} drugs are required')
+    maxrates = _per_drug(maxrate, nd)
+    plasmas = _per_drug(plasma, nd)
+    if dt is None:
+        dt = models[0].dt
+
+    # target changes in steps on the shared timeline
+    if tmax is None:
+        tmax = max(_changepoints(ct, None, dt)[2] for ct in cts) * dt if nd else 0
+    n = int(round(tmax / dt))
+    changes = []
+    for ct in cts:
+        if np.ndim(ct) == 2:
+            times, targets, _ = _changepoints(ct, tmax, dt)
+        else:
+            times, targets, _ = _changepoints(np.r_[ct, 0] if len(ct) < n else ct, dt=dt)
+        keep = times < n
+        changes.append((times[keep], targets[keep]))
+
+    # block-diagonal update: the modal states of all drugs in one vector of 4 * nd
+    modes = [_modes(m.k10, m.k12, m.k13, m.k21, m.k31, m.ke0, m.v1_v4, m.method, dt) for m in models]
+    mu = np.concatenate([x[0] for x in modes])
+    h = np.concatenate([x[1] for x in modes])
+    out = np.zeros((4 * nd, 2 * nd), dtype=mu.dtype)  # modal states to Cp and Ce of every drug
+    euler = np.array([m.method == 'euler' for m in models])
+    for d, (m, x) in enumerate(zip(models, modes)):
+        out[4 * d:4 * d + 4, 2 * d:2 * d + 2] = x[2][[0, 3]].T / m.v1 * np.array([1, m.v1_v4])
+
+    ret = np.zeros((n, nd, 5))
+    for d, (times, targets) in enumerate(changes):
+        for t, e, ct in zip(times, np.r_[times[1:], n], targets):
+            ret[t:e, d, 0] = ct
+    response = np.empty(n) if surface is not None else None
+
+    z = np.zeros(4 * nd, dtype=np.result_type(mu, h))
+    rates = np.zeros(nd)
+    states = [_decision_state() for _ in models]
+    nxt_change = [0] * nd  # index of the next target change of every drug
+    i = 0
+    while i < n:
+        nxt = n
+        for d, m in enumerate(models):
+            times = changes[d][0]
+            while nxt_change[d] < len(times) and times[nxt_change[d]] <= i:
+                nxt_change[d] += 1
+            amounts = lambda: (modes[d][2] @ z[4 * d:4 * d + 4]).real
+            nxt = min(nxt, i + _decide(m, i, ret[i, d, 0], states[d], amounts, maxrates[d], plasmas[d], dt))
+            rates[d] = states[d]['rate']
+
+            # the next event of any drug
+            if nxt_change[d] < len(times):
+                nxt = min(nxt, times[nxt_change[d]])
+
+        z, conc = _segment(z, np.repeat(rates, 4), nxt - i, mu, h, out, euler)
+        conc = conc.reshape(-1, nd, 2)
+        ret[i:nxt, :, 1:3] = conc
+        ret[i:nxt, :, 3] = rates
+        if surface is not None:
+            response[i:nxt] = surface(*conc[:, :, 1].T)
+        i = nxt
+    ret[:, :, 4] = np.cumsum(ret[:, :, 3], axis=0) * dt
+    if surface is not None:
+        return ret, response
+    return ret
@@ -0,0 +1,78 @@
+import numpy as np
+from . import _kparams
+from .batch import ModelBatch
+
+params = ('v1', 'v2', 'v3', 'cl1', 'cl2', 'cl3', 'ke0')  # parameters with the random effects
+
+
+def _volumes(model):
+    '''
+    volumes (L), clearances (L/min) and ke0 (/min) of the model or the batch
+    '''
+    v1 = np.asarray(model.v1, dtype=float)
+    k21 = np.asarray(model.k21, dtype=float)
+    k31 = np.asarray(model.k31, dtype=float)
+    v2 = np.where(k21 != 0, v1 * model.k12 / np.where(k21 != 0, k21, 1), 0)
+    v3 = np.where(k31 != 0, v1 * model.k13 / np.where(k31 != 0, k31, 1), 0)
+    return {'v1': v1, 'v2': v2, 'v3': v3, 'cl1': v1 * model.k10, 'cl2': v1 * model.k12, 'cl3': v1 * model.k13, 'ke0': np.asarray(model.ke0, dtype=float)}
+
+
+def sample_iiv(model, n, omega, seed=None):
+    '''
+    draw the parameters of n patients with the log-normal random effects around the typical values of the model
+    p_i = p * exp(eta_i) where eta_i ~ N(0, omega[p] ** 2)
+    model: Model of the typical patient
+    omega: dict of the standard deviations of the random effects of 'v1', 'v2', 'v3', 'cl1', 'cl2', 'cl3', 'ke0'
+        the parameters without the key have no random effect
+    seed: seed of the random number generator (numpy.random.default_rng) for the reproducible draws
+    returns: ModelBatch of the draws
+    '''
+    unknown = set(omega) - set(params)
+    if unknown:
+        raise ValueError(f'unsupported parameters {sorted(unknown)}')
+    sd = np.array([omega.get(key, 0) for key in params], dtype=float)
+    eta = np.random.default_rng(seed).standard_normal((n, len(params))) * sd  # always draw every parameter for the same seed
+    typ = _volumes(model)
+    p = {key: typ[key] * np.exp(eta[:, j]) for j, key in enumerate(params)}
+    k = _kparams({'v1': p['v1'], 'v2': p['v2'], 'v3': p['v3'], 'q1': p['cl1'], 'q2': p['cl2'], 'q3': p['cl3'], 'ke0': p['ke0']})
+    return ModelBatch.from_params(*k, method=model.method)
+
+
+def montecarlo(model, cts, omega, n=1000, seed=None, percentiles=(5, 50, 95), maxrate=None, plasma=False, event=False, tmax=None, every=1):
+    '''
+    prediction intervals of the concentrations with the inter-individual variability
+    the rates of Model.run for the typical patient are given to n draws of the parameters (see sample_iiv)
+    and all draws are propagated together with the modal recursion of their rate matrices
+    the percentiles are computed over the draws at every step, so the memory is O(n + len(cts)) and no trajectory is stored
+    cts, maxrate, plasma, event, tmax: see Model.run
+    omega, n, seed: see sample_iiv
+    percentiles: percentiles of the prediction intervals
+    every: compute the percentiles every given steps
+    returns: dict of 'Ct', 'Rate' and 'Infused' of the typical patient at every step,
+        'Time' (steps) of the rows of 'Cp' and 'Ce' in the shape (len(Time), len(percentiles)) and 'percentiles'
+    '''
+    dt = model.dt
+    typical = model._run(cts, maxrate, plasma, event, tmax)
+    rates = typical[:, 3]
+    batch = sample_iiv(model, n, omega, seed)
+
+    mu, h, v, _ = batch._modes(dt)
+    mu = np.ascontiguousarray(mu.T)  # (4, n)
+    h = np.ascontiguousarray(h.T)
+    out_cp = np.ascontiguousarray(v[:, 0, :].T / batch.v1)  # modal state to Cp
+    out_ce = np.ascontiguousarray(v[:, 3, :].T / batch.v1 * batch.v1_v4)  # modal state to Ce
+    z = np.zeros((4, n), dtype=np.result_type(mu, h))
+
+    times = np.arange(every - 1, len(rates), every)
+    cps = np.empty((len(times), len(percentiles)))
+    ces = np.empty((len(times), len(percentiles)))
+    j = 0
+    for i, rate in enumerate(rates):
+        z *= mu
+        if rate:
+            z += h * rate
+        if j < len(times) and i == times[j]:
+            cps[j] = np.percentile(np.einsum('in,in->n', out_cp, z).real, percentiles)
+            ces[j] = np.percentile(np.einsum('in,in->n', out_ce, z).real, percentiles)
+            j += 1
+    return {'Ct': typical[:, 0], 'Rate': rates, 'Infused': typical[:, 4], 'Time': times, 'Cp': cps, 'Ce': ces, 'percentiles': np.asarray(percentiles)}
@@ -0,0 +1,113 @@
+import os
+import time
+import concurrent.futures
+import numpy as np
+from . import Model
+from .storage import _open_sink
+
+
+def make_model(scenario):
+    '''
+    build the model of a scenario
+    scenario: dict with 'model' (Model) or 'name' with the optional 'age', 'sex', 'weight', 'height', 'method'
+    '''
+    if 'model' in scenario:
+        return scenario['model']
+    keys = ('age', 'sex', 'weight', 'height', 'method')
+    return Model(scenario['name'], **{key: scenario[key] for key in keys if key in scenario})
+
+
+def run_scenario(scenario):
+    '''
+    run Model.run for a scenario (see run_many)
+    returns: array in the shape (len(cts), 5) of the columns Model.columns
+    '''
+    model = make_model(scenario)
+    return model._run(scenario['cts'], scenario.get('maxrate'), scenario.get('plasma', False), scenario.get('event', False), scenario.get('tmax'), scenario.get('dt'))
+
+
+def _run_chunk(chunk):
+    return [run_scenario(scenario) for scenario in chunk]
+
+
+def profile_scenario(scenario):
+    '''
+    run_scenario with the timings of the stages
+    returns: (result, (seconds of the model construction, the tci solving, the propagation))
+    '''
+    start = time.perf_counter()
+    model = make_model(scenario)
+    built = time.perf_counter()
+    log, model.tci_log = model.tci_log, []
+    try:
+        ret = model._run(scenario['cts'], scenario.get('maxrate'), scenario.get('plasma', False), scenario.get('event', False), scenario.get('tmax'), scenario.get('dt'))
+        tci = sum(x[2] for x in model.tci_log)
+    finally:
+        model.tci_log = log
+    end = time.perf_counter()
+    return ret, (built - start, tci, end - built - tci)
+
+
+def _profile_chunk(chunk):
+    return [profile_scenario(scenario) for scenario in chunk]
+
+
+def iter_many(scenarios, workers=None, chunksize=1, profile=False):
+    '''
+    generator that runs the scenarios over a process pool (see run_many) and yields the results as soon as they are finished
+    profile: if True, yield the results of profile_scenario instead of run_scenario
+    yields: (index of the scenario, result) in the order of the completion
+    '''
+    scenarios = list(scenarios)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    func = _profile_chunk if profile else _run_chunk
+    starts = range(0, len(scenarios), chunksize)
+    if workers == 1:
+        for start in starts:
+            yield from enumerate(func(scenarios[start:start + chunksize]), start)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, scenarios[start:start + chunksize]): start for start in starts}
+        for future in concurrent.futures.as_completed(futures):
+            yield from enumerate(future.result(), futures[future])
+
+
+def run_many(scenarios, workers=None, chunksize=1, outdir=None, sink=None):
+    '''
+    run Model.run for every scenario over a process pool
+    scenarios: list of dict with the keys
+        'model': Model or 'name', 'age', 'sex', 'weight', 'height', 'method' to build the model
+        'cts': target concentration at every second or the list of (time, target) at the target changes
+        'maxrate', 'plasma', 'event', 'tmax', 'dt': (optional) arguments of Model.run
+    workers: number of processes (if None, os.cpu_count(); if 1, run in this process)
+    chunksize: number of scenarios sent to a worker at once to amortize the cost of pickling
+    outdir: if given, each scenario is saved to outdir/{index}.npy as soon as it is finished and the path is returned instead of the array
+    sink: ResultWriter with the index ('Case',) or its directory, to which the rows of each scenario are appended as soon as it is finished
+        with the index of the scenario in the Case column, and the number of the rows is returned instead of the array
+    returns: list of arrays in the shape (len(cts), 5) of the columns Model.columns in the order of the scenarios
+    '''
+    scenarios = list(scenarios)
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+
+    writer = None
+    if sink is not None:
+        writer, owned = _open_sink(sink, Model.columns, ('Case',))
+
+    ret = [None] * len(scenarios)
+    try:
+        for i, res in iter_many(scenarios, workers, chunksize):
+            if outdir:
+                path = os.path.join(outdir, f'{i}.npy')
+                np.save(path, res)
+                res = path
+            elif writer is not None:
+                writer.write(res, Case=i)
+                res = len(res)
+            ret[i] = res
+        return ret
+    finally:
+        if writer is not None and owned:
+            writer.close()
@@ -0,0 +1,104 @@
+import numpy as np
+from . import _modes
+
+
+class Replayer:
+    '''
+    replay of the recorded infusion histories as a linear filter
+    every exponential mode of the compartments is a first order recursive (IIR) filter of the doses,
+    z(t+1) = mu * z(t) + h * dose(t), which is evaluated by scipy.signal.lfilter over the whole chunk
+    the modal state is kept between the chunks, so the records can be streamed in pieces of any length
+    the result equals Model.sim with the same doses
+    '''
+    def __init__(self, model, a=None, method=None):
+        '''
+        model: Model to replay
+        a: initial state of the compartments in the shape (4,) or (N, 4) for N records
+        method: 'euler' or 'exact' (if None, use the model.method)
+        '''
+        if method is None:
+            method = model.method
+        if method not in ('euler', 'exact'):
+            raise ValueError('unsupported method')
+        self.model = model
+        self.method = method
+        self._mu, self._h, self._v, vinv = _modes(model.k10, model.k12, model.k13, model.k21, model.k31, model.ke0, model.v1_v4, method)
+        if a is None:
+            a = np.zeros(4)
+        self._z = np.asarray(a, dtype=float) @ vinv.T  # modal state
+        self.t = 0  # elapsed seconds
+        self.rate = 0  # current rate of feed_events()
+
+    @property
+    def a(self):
+        '''
+        current amounts in the compartments
+        '''
+        return (self._z @ self._v.T).real
+
+    def feed(self, doses):
+        '''
+        replay the next chunk of the doses
+        doses: infused amount at every second in the shape (n,) or (N, n) for N records
+            the same doses of the shape (n,) are given to every record of the initial states in the shape (N, 4)
+        returns: amounts in the compartments in the shape (n, 4) or (N, n, 4) as Model.sim
+        '''
+        from scipy.signal import lfilter
+
+        doses = np.asarray(doses, dtype=float)
+        n = doses.shape[-1]
+        doses = np.broadcast_to(doses, np.broadcast_shapes(doses.shape[:-1], self._z.shape[:-1]) + (n,))
+        z = np.broadcast_to(self._z, doses.shape[:-1] + (4,))
+        zs = np.empty(doses.shape + (4,), dtype=np.result_type(self._mu, self._h))
+        for k in range(4):  # every mode is an independent IIR filter
+            zi = (self._mu[k] * z[..., k])[..., None]  # the previous output of the filter
+            zs[..., k], _ = lfilter([self._h[k]], [1, -self._mu[k]], doses, axis=-1, zi=zi)
+        if n:
+            self._z = zs[..., -1, :].copy()
+        self.t += n
+        return (zs @ self._v.T).real
+
+    def feed_events(self, times, rates, until):
+        '''
+        replay the timestamped rate changes until the given time
+        the rate is constant between the changes and the amount infused in each second is integrated exactly,
+        so the changes do not need to be on the second boundaries
+        times: the seconds of the rate changes (sorted, self.t <= times < until)
+        rates: the infused amount per second from each time
+        until: the end of the chunk in seconds from the start of the record (integer)
+        returns: amounts in the compartments at every second from self.t to until in the shape (until - self.t, 4)
+        '''
+        times = np.asarray(times, dtype=float)
+        rates = np.asarray(rates, dtype=float)
+        start = self.t
+        # cumulative infused amount is piecewise linear between the rate changes
+        knots = np.r_[start, times, until]
+        slopes = np.r_[self.rate, rates]
+        cum = np.r_[0, np.cumsum(slopes * np.diff(knots))]
+        doses = np.diff(np.interp(np.arange(start, until + 1), knots, cum))
+        if len(rates):
+            self.rate = rates[-1]
+        return self.feed(doses)
+
+    def stream(self, chunks):
+        '''
+        generator that replays the iterable of the dose chunks
+        yields: amounts in the compartments of every chunk (see feed)
+        '''
+        for doses in chunks:
+            yield self.feed(doses)
+
+
+def replay(model, doses, a=None, method=None, chunksize=None):
+    '''
+    replay the recorded doses with the linear filter (see Replayer)
+    doses: infused amount at every second in the shape (n,) or (N, n) for N records
+    chunksize: if given, replay in chunks of this many seconds to limit the temporary memory
+    returns: amounts in the compartments in the shape (n, 4) or (N, n, 4) as Model.sim
+    '''
+    rep = Replayer(model, a, method)
+    doses = np.asarray(doses, dtype=float)
+    if chunksize is None:
+        return rep.feed(doses)
+    n = doses.shape[-1]
+    return np.concatenate([rep.feed(doses[..., i:i + chunksize]) for i in range(0, n, chunksize)] or [rep.feed(doses)], axis=-2)
@@ -0,0 +1,225 @@
+import os
+import ast
+import numpy as np
+
+HEADER_SIZE = 128  # fixed size of the .npy header, so it can be rewritten with the final shape
+MARK = 'tivatci.ResultWriter'  # comment in the .npy header and key of the parquet metadata of the files of ResultWriter
+
+
+def _npy_header(dtype, n):
+    '''
+    header of a 1-D .npy file (version 1.0) padded to HEADER_SIZE bytes
+    the header ends with the comment of MARK, which numpy ignores
+    '''
+    d = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), } # %s" % (np.lib.format.dtype_to_descr(np.dtype(dtype)), n, MARK)
+    size = HEADER_SIZE - 10  # magic string, version and header length
+    return np.lib.format.magic(1, 0) + size.to_bytes(2, 'little') + d.ljust(size - 1).encode('latin1') + b'\n'
+
+
+def _read_npy_header(f):
+    '''
+    returns: (dtype, number of rows) of a .npy file written by ResultWriter
+    '''
+    head = f.read(HEADER_SIZE)
+    if len(head) != HEADER_SIZE or head[:6] != b'\x93NUMPY' or int.from_bytes(head[8:10], 'little') != HEADER_SIZE - 10 \
+            or ('# ' + MARK).encode('latin1') not in head:
+        raise ValueError('not a file of ResultWriter')
+    d = ast.literal_eval(head[10:].decode('latin1'))
+    return np.dtype(d['descr']), d['shape'][0]
+
+
+def _is_npy(fpath):
+    '''
+    True if the file is a .npy column written by ResultWriter
+    '''
+    try:
+        with open(fpath, 'rb') as f:
+            _read_npy_header(f)
+        return True
+    except (OSError, ValueError, SyntaxError):
+        return False
+
+
+def _is_part(fpath):
+    '''
+    True if the file is a parquet part written by ResultWriter
+    '''
+    try:
+        import pyarrow.parquet as pq
+        return MARK.encode() in (pq.read_schema(fpath).metadata or {})
+    except Exception:  # not a parquet file or no pyarrow
+        return False
+
+
+def _results(path):
+    '''
+    returns: (.npy columns, parquet parts) written by ResultWriter in the directory (sorted file names)
+    '''
+    names = sorted(os.listdir(path))
+    npys = [x for x in names if x.endswith('.npy') and _is_npy(os.path.join(path, x))]
+    parts = [x for x in names if x.startswith('part-') and x.endswith('.parquet') and _is_part(os.path.join(path, x))]
+    return npys, parts
+
+
+class ResultWriter:
+    '''
+    sink of the simulation results that writes every column in chunks to a binary columnar format
+    'npy': directory with one .npy file per column, which can be memory-mapped by read_results
+        the header of each file has a fixed size and is rewritten with the number of rows on flush and close
+    'parquet': directory of parquet files (one per writer) with pyarrow
+    '''
+    def __init__(self, path, columns=('Ct', 'Cp', 'Ce', 'Rate', 'Infused'), dtype=np.float32, mode='w', format='npy', index=()):
+        '''
+        path: directory of the columns
+        columns: names of the value columns
+        dtype: type of the value columns
+        mode: 'w' to overwrite (the files of any ResultWriter in the directory are removed) or 'a' to append to the existing results
+            the other files in the directory are kept, and a .npy file of a column that was not written by ResultWriter is an error
+        format: 'npy' or 'parquet'
+        index: names of the integer columns which are given to write() by keyword (e.g. ('Case',) or ('Case', 'Time'))
+        '''
+        if mode not in ('w', 'a'):
+            raise ValueError('unsupported mode')
+        if format not in ('npy', 'parquet'):
+            raise ValueError('unsupported format')
+        self.path = path
+        self.columns = tuple(columns)
+        self.index = tuple(index)
+        self.dtype = np.dtype(dtype)
+        self.format = format
+        self.nrows = 0
+        self._dtypes = [np.dtype(np.int64)] * len(self.index) + [self.dtype] * len(self.columns)
+        os.makedirs(path, exist_ok=True)
+
+        npys, parts = _results(path)
+        for name in self.index + self.columns:
+            if os.path.exists(os.path.join(path, name + '.npy')) and name + '.npy' not in npys:
+                raise ValueError(f'{name}.npy in {path} was not written by ResultWriter')
+        if mode == 'w':
+            for x in npys + parts:
+                os.remove(os.path.join(path, x))
+            npys, parts = [], []
+        elif npys if format == 'parquet' else parts:
+            raise ValueError('the directory has the results of another format')
+
+        if format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            fields = [(name, pa.int64()) for name in self.index] + [(name, pa.from_numpy_dtype(self.dtype)) for name in self.columns]
+            self._schema = pa.schema(fields, metadata={MARK: '1'})
+            i = len(parts)
+            while os.path.exists(os.path.join(path, f'part-{i:05d}.parquet')):  # a file of another writer
+                i += 1
+            self._writer = pq.ParquetWriter(os.path.join(path, f'part-{i:05d}.parquet'), self._schema)
+            return
+
+        paths = [os.path.join(path, name + '.npy') for name in self.index + self.columns]
+        exists = [os.path.exists(fpath) for fpath in paths]
+        append = mode == 'a' and all(exists)
+        if mode == 'a' and any(exists) and not append:
+            raise ValueError('the columns do not match the existing results')
+        self._files = []
+        for fpath, dtype in zip(paths, self._dtypes):
+            if append:
+                f = open(fpath, 'r+b')
+                old_dtype, n = _read_npy_header(f)
+                if old_dtype != dtype:
+                    raise ValueError(f'dtype of {fpath} is {old_dtype}')
+                if self._files and n != self.nrows:
+                    raise ValueError('the columns have different lengths')
+                self.nrows = n
+                f.seek(HEADER_SIZE + n * dtype.itemsize)
+                f.truncate()  # drop the rows written after the last flush
+            else:
+                f = open(fpath, 'w+b')
+                f.write(_npy_header(dtype, 0))
+            self._files.append(f)
+
+    def write(self, data, **index):
+        '''
+        append rows
+        data: array in the shape (n, len(columns)), structured array or dict of the columns
+        index: values of the index columns, scalars or arrays in the shape (n,)
+        '''
+        if isinstance(data, dict) or data.dtype.names:
+            cols = [np.asarray(data[name]) for name in self.columns]
+        else:
+            data = np.asarray(data)
+            if data.ndim != 2 or data.shape[1] != len(self.columns):
+                raise ValueError(f'data must be in the shape (n, {len(self.columns)})')
+            cols = list(data.T)
+        n = len(cols[0])
+        if set(index) != set(self.index):
+            raise ValueError(f'index columns {self.index} are required')
+        cols = [np.broadcast_to(np.asarray(index[name], dtype=np.int64), (n,)) for name in self.index] + cols
+
+        cols = [np.ascontiguousarray(col, dtype=dtype) for col, dtype in zip(cols, self._dtypes)]
+        if self.format == 'parquet':
+            import pyarrow as pa
+            self._writer.write_table(pa.Table.from_arrays([pa.array(col) for col in cols], schema=self._schema))
+        else:
+            for f, col in zip(self._files, cols):
+                f.write(col.tobytes())
+        self.nrows += n
+
+    def flush(self):
+        '''
+        rewrite the headers with the current number of rows so that the files can be read while writing
+        '''
+        if self.format == 'npy':
+            for f, dtype in zip(self._files, self._dtypes):
+                f.seek(0)
+                f.write(_npy_header(dtype, self.nrows))
+                f.seek(0, os.SEEK_END)
+                f.flush()
+
+    def close(self):
+        if self.format == 'parquet':
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            return
+        if self._files:
+            self.flush()
+            for f in self._files:
+                f.close()
+            self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f'ResultWriter({self.path!r}, format={self.format!r}, nrows={self.nrows})'
+
+
+def read_results(path, mmap=True):
+    '''
+    read the results written by ResultWriter (the other files in the directory are ignored)
+    mmap: if True, memory-map the .npy columns instead of reading them into memory
+    returns: dict of the columns
+    '''
+    npys, parts = _results(path)
+    if parts:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.concat_tables([pq.read_table(os.path.join(path, x), memory_map=mmap) for x in parts])
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+    ret = {}
+    for x in npys:
+        ret[x[:-4]] = np.load(os.path.join(path, x), mmap_mode='r' if mmap else None)
+    return ret
+
+
+def _open_sink(sink, columns, index=()):
+    '''
+    sink: ResultWriter or the directory for a new ResultWriter
+    returns: (writer, True if the writer should be closed by the caller)
+    '''
+    if isinstance(sink, ResultWriter):
+        if sink.columns != tuple(columns) or sink.index != tuple(index):
+            raise ValueError(f'the sink must have the columns {tuple(columns)} and the index {tuple(index)}')
+        return sink, False
+    return ResultWriter(sink, columns, index=index), True